@@ -18,14 +18,28 @@
 # USA.
 
 
+import contextlib
+import functools
+import hashlib
 import logging
+import math
 import multiprocessing
+import pickle
+import re
+import signal
+import threading
+import time
 
 
+import babelfish
 import guessit
 
 
 from arroyo import schema
+from arroyo.services.cache import (
+    CacheKeyError,
+    CacheKeyExpiredError
+)
 
 
 class Tags:
@@ -86,33 +100,513 @@ KNOWN_DISTRIBUTORS = [
     'ettv',
     'eztv',
     'rartv'
-]  # keep lower case!!
+]  # Default list, see set_distributors()
+
+# Tokens understood by fast_parse() mapped to the same (key, value) pairs
+# guessit produces for them. Only tokens whose meaning doesn't depend on
+# context must be here, any other token sends the name to guessit.
+FAST_PARSE_TOKENS = {
+    '480p': [('screen_size', '480p')],
+    '576p': [('screen_size', '576p')],
+    '720p': [('screen_size', '720p')],
+    '1080p': [('screen_size', '1080p')],
+    '2160p': [('screen_size', '2160p')],
+    'bluray': [('source', 'Blu-ray')],
+    'brrip': [('source', 'Blu-ray'), ('other', 'Reencoded'),
+              ('other', 'Rip')],
+    'hdtv': [('source', 'HDTV')],
+    'pdtv': [('source', 'Digital TV')],
+    'web': [('source', 'Web')],
+    'web-dl': [('source', 'Web')],
+    'webrip': [('source', 'Web'), ('other', 'Rip')],
+    'h264': [('video_codec', 'H.264')],
+    'h.264': [('video_codec', 'H.264')],
+    'x264': [('video_codec', 'H.264')],
+    'h265': [('video_codec', 'H.265')],
+    'h.265': [('video_codec', 'H.265')],
+    'x265': [('video_codec', 'H.265')],
+    'hevc': [('video_codec', 'H.265'),
+             ('video_profile', 'High Efficiency Video Coding')],
+    'xvid': [('video_codec', 'Xvid')],
+    'aac': [('audio_codec', 'AAC')],
+    'ac3': [('audio_codec', 'Dolby Digital')],
+    'mp3': [('audio_codec', 'MP3')],
+    'internal': [('other', 'Internal')],
+    'proper': [('other', 'Proper'), ('proper_count', 1)],
+    'repack': [('other', 'Proper'), ('proper_count', 1)],
+}
+
+# guessit only takes these as streaming services when followed by WEB-DL or
+# WEBRip, so they are tokens along with them (i.e. 'AMZN.WEB-DL')
+FAST_PARSE_STREAMING_SERVICES = {
+    'amzn': 'Amazon Prime',
+    'dsny': 'Disney',
+    'nf': 'Netflix',
+}
+FAST_PARSE_TOKENS.update({
+    service + '.' + source: ([('streaming_service', name)] +
+                             FAST_PARSE_TOKENS[source])
+    for (service, name) in FAST_PARSE_STREAMING_SERVICES.items()
+    for source in ('web-dl', 'webrip')
+})
+
+# Audio codecs followed by their channels, i.e. 'DDP5.1'
+FAST_PARSE_AUDIO_CODECS = {
+    'aac': 'AAC',
+    'dd': 'Dolby Digital',
+    'ddp': 'Dolby Digital Plus',
+}
+
+FAST_PARSE_CONTAINERS = {
+    'avi': 'video/x-msvideo',
+    'mkv': 'video/x-matroska',
+    'mp4': 'video/mp4',
+}
+
+# Words guessit may take as something else than part of a title (tested
+# against it)
+FAST_PARSE_UNSAFE_WORDS = set(FAST_PARSE_TOKENS) | {
+    *FAST_PARSE_STREAMING_SERVICES,
+    'ahdtv', 'alternative', 'asf', 'asrequested', 'atmos', 'audio',
+    'australia', 'avc', 'avi', 'bd', 'bonus', 'brazilian', 'cam', 'cap',
+    'capitulo', 'capitulos', 'castellano', 'cc', 'cd', 'classic', 'collector',
+    'colorized', 'com', 'complet', 'complete', 'convert', 'customsub',
+    'customsubbed', 'customsubs', 'dc', 'dd', 'ddc', 'ddp', 'deluxe', 'dirfix',
+    'disc', 'divx', 'dm', 'docu', 'doku', 'dolby', 'dolbydigital', 'dsr',
+    'dth', 'dts', 'dual', 'dub', 'dubbed', 'dublado', 'dvb', 'dvd', 'dvdivx',
+    'dvdrip', 'dxva', 'edition', 'enc', 'ep', 'episode', 'episodes',
+    'episodio', 'episodios', 'eps', 'espanol', 'esub', 'esubs', 'extended',
+    'extras', 'fansub', 'fastsub', 'fhd', 'final', 'flac', 'flemish', 'flv',
+    'hardsub', 'hd', 'hdlight', 'hdr', 'hfr', 'hq', 'hr', 'idx', 'imax', 'iso',
+    'lame', 'ld', 'ldtv', 'legenda', 'legendado', 'legendas', 'limited',
+    'lpcm', 'mbcvod', 'md', 'mhd', 'minisode', 'minisodes', 'mka', 'mkv',
+    'mono', 'mov', 'mpeg', 'mpg', 'multi', 'net', 'nfofix', 'ntsc', 'nzb',
+    'oar', 'oav', 'ogg', 'ogm', 'ogv', 'om', 'opus', 'org', 'ov', 'ova', 'pal',
+    'part', 'pcm', 'pilot', 'postbot', 'ppv', 'preair', 'prooffix', 'pt',
+    'ptbr', 'qt', 'ra', 'ram', 'rc', 'real', 'reencoded', 'remastered',
+    'remux', 'rerip', 'retail', 'rm', 'saison', 'saisons', 'screener', 'sd',
+    'sdr', 'season', 'seasons', 'secam', 'seizoen', 'soft', 'special', 'srt',
+    'ssa', 'stagione', 'stereo', 'stv', 'subbed', 'subforced', 'subs',
+    'subtitles', 'subtitulado', 'swissgerman', 'tc', 'telecine', 'telesync',
+    'tem', 'temp', 'temporada', 'temporadas', 'theatrical', 'torrent',
+    'trailer', 'truehd', 'ts', 'uhd', 'unaired', 'uncensored', 'uncut',
+    'undetermined', 'unrated', 'upscaled', 'vfr', 'vhs', 'vita', 'vo', 'vob',
+    'vod', 'vol', 'volume', 'vorbis', 'vost', 'wav', 'widescreen', 'wma',
+    'wmv', 'workprint', 'wp', 'ws', 'xpost', 'xxx'
+}
+
+# guessit only looks for these languages and countries (its default
+# 'allowed_languages' and 'allowed_countries' options), titles with words
+# that can name one of them are left to it
+FAST_PARSE_LANGUAGES = [
+    'ca', 'cs', 'de', 'en', 'es', 'fr', 'he', 'hi', 'hu', 'it', 'ja', 'ko',
+    'nl', 'no', 'pl', 'pt', 'ro', 'ru', 'sv', 'te', 'uk'
+]
+FAST_PARSE_COUNTRIES = ['au', 'gb', 'us']
+
+# Language and country synonyms known by guessit
+FAST_PARSE_LANGUAGE_SYNONYMS = {
+    'br', 'cn', 'cz', 'dl', 'esp', 'gr', 'jp', 'mul', 'multi', 'pb', 'po',
+    'pob', 'scr', 'se', 'ua', 'uk', 'und', 'vf', 'vff', 'vfi', 'vfq'
+}
+
+
+def _language_words():
+    ret = set(FAST_PARSE_LANGUAGE_SYNONYMS)
+    for code in FAST_PARSE_LANGUAGES:
+        lang = babelfish.Language.fromalpha2(code)
+        ret.update([code, lang.alpha3, lang.alpha3b, lang.alpha3t,
+                    lang.name.lower()])
+
+    ret.update(FAST_PARSE_COUNTRIES)
+    return ret
+
+
+_FAST_LANGUAGE_WORDS = _language_words()
+
+# guessit's own vocabulary, built on first use (see _guessit_vocabulary())
+_fast_vocabulary = None
+
+_FAST_TITLE = r'(?P<title>[a-z]{2,}(?:\.[a-z]{2,})*)'
+
+_FAST_EPISODE_RE = re.compile(
+    '^' + _FAST_TITLE + r'(?:\.(?P<year>(?:19|20)\d{2}))?'
+    r'\.s(?P<season>\d{2})(?:e(?P<episode>\d{2}))?(?P<tail>[.\-].*)$',
+    re.IGNORECASE)
+
+_FAST_MOVIE_RE = re.compile(
+    '^' + _FAST_TITLE + r'\.(?P<year>(?:19|20)\d{2})(?P<tail>[.\-].*)$',
+    re.IGNORECASE)
+
+# Pieces of the tail of a name (after the episode or year): tags, episode
+# title words, the release group and the container. Longest tokens go
+# first so 'WEB-DL' isn't taken as 'WEB' from group 'DL'.
+_FAST_TAG_RE = re.compile(
+    r'\.(?:(?P<audio>' + '|'.join(FAST_PARSE_AUDIO_CODECS) + r')'
+    r'(?P<channels>\d\.\d)'
+    r'|(?P<token>' + '|'.join(
+        re.escape(x) for x in sorted(FAST_PARSE_TOKENS, key=len,
+                                     reverse=True)) + r'))'
+    r'(?=[.\-]|$)',
+    re.IGNORECASE)
+_FAST_WORD_RE = re.compile(r'\.(?P<word>[a-z]+)(?=[.\-]|$)', re.IGNORECASE)
+_FAST_GROUP_RE = re.compile(
+    r'-(?P<release_group>[a-z0-9]+)'
+    r'(?:\.(?P<container>' + '|'.join(FAST_PARSE_CONTAINERS) + r'))?$',
+    re.IGNORECASE)
+
+# Bump this if parse() changes its output in a way that invalidates results
+# stored in a ParseCache
+PARSER_VERSION = 5
+
+# Distributor tags in use and their matcher, see set_distributors()
+_distributors = []
+_distributors_re = None
+
+# Names that took longer than the time budget to parse. They are skipped
+# for the lifetime of the process (and for good if there is a ParseCache,
+# where the timeout error is stored as any other result)
+_quarantine = {}
+
+
+def analyze(*sources, mp=True, cache=None, pool=None, timeout=None,
+            lazy=False):
+    ret = sorted(_analyze_iter(sources, mp, cache, pool, timeout, lazy),
+                 key=lambda x: x[0])
+
+    return [src for (idx, src) in ret]
+
+
+def analyze_iter(*sources, mp=True, cache=None, pool=None, timeout=None,
+                 lazy=False):
+    """
+    Same as analyze() but yields each source as soon as it's analyzed
+    instead of returning all of them at once. Sources are yielded in
+    completion order (cache hits first).
+    """
+    for (idx, src) in _analyze_iter(sources, mp, cache, pool, timeout,
+                                    lazy):
+        yield src
+
+
+def _analyze_iter(sources, mp, cache, pool, timeout, lazy):
+    # Sources with the same name (and type hint) share the same parse result,
+    # the first index of each group is the one sent to parse.
+    misses = {}
+
+    for (idx, src) in enumerate(sources):
+        type_hint = src.hints.get('type')
+
+        if (src.name, type_hint) in _quarantine:
+            yield from _build_analyzed(idx, src,
+                                       _quarantine[(src.name, type_hint)],
+                                       lazy)
+            continue
 
+        if cache is not None:
+            try:
+                res = cache.get(src.name, type_hint)
+            except CacheKeyError:
+                pass
+            else:
+                yield from _build_analyzed(idx, src, res, lazy)
+                continue
+
+        misses.setdefault((src.name, type_hint), []).append(idx)
+
+    if not misses:
+        return
+
+    shared = sum([len(x) - 1 for x in misses.values()])
+    if shared:
+        logmsg = "%s sources share parse results with others"
+        logmsg = logmsg % shared
+        _logger.info(logmsg)
+
+    items = [(idxs[0], name, type_hint, timeout)
+             for ((name, type_hint), idxs) in misses.items()]
+    groups = {idxs[0]: idxs for idxs in misses.values()}
+
+    if not mp and timeout and _time_limit_needs_worker():
+        # Time limits don't work in this thread, parse in a worker process
+        # where they do
+        mp = True
+        if pool is None:
+            pool = _time_limit_pool
+
+    if not mp:
+        results = map(_safe_parse_item, items)
+        yield from _collect_parsed(sources, groups, cache, results, lazy)
+
+    elif pool is None:
+        with WorkerPool() as tmppool:
+            results = tmppool.imap_unordered(_safe_parse_item, items)
+            yield from _collect_parsed(sources, groups, cache, results, lazy)
 
-def analyze(*sources, mp=True):
-    if mp:
-        with multiprocessing.Pool(multiprocessing.cpu_count()) as pool:
-            ret = pool.map(_safe_analyze_one, sources)
     else:
-        ret = list(map(_safe_analyze_one, sources))
+        results = pool.imap_unordered(_safe_parse_item, items)
+        yield from _collect_parsed(sources, groups, cache, results, lazy)
+
+
+def _collect_parsed(sources, groups, cache, results, lazy):
+    for (idx, res) in results:
+        src = sources[idx]
+        _store_parsed(src.name, src.hints.get('type'), res, cache)
+
+        for idx in groups[idx]:
+            yield from _build_analyzed(idx, sources[idx], res, lazy)
+
+
+def _store_parsed(name, type_hint, res, cache):
+    if isinstance(res, AnalysisTimeoutError):
+        if (name, type_hint) not in _quarantine:
+            logmsg = "Quarantined '%s': %s"
+            logmsg = logmsg % (name, res)
+            _logger.warning(logmsg)
+
+        _quarantine[(name, type_hint)] = res
+
+    if cache is not None:
+        cache.set(name, type_hint, res)
+
+
+def _build_analyzed(idx, src, res, lazy):
+    if isinstance(res, NormalizationError):
+        logmsg = "Error analyzing '%s'"
+        logmsg = logmsg % src.name
+        _logger.warning(logmsg)
+        return
+
+    yield (idx, _build_analyzed_source(src, res, lazy))
+
+
+def dedup(*sources):
+    """
+    Collapse sources with the same id (the same infohash, i.e. the same
+    torrent scraped from several providers or pages) into one.
+
+    Merge policy:
+      - name, uri and provider are taken from the first source
+      - seeds and leechers: highest known value
+      - created: oldest known timestamp
+      - size: first known value
+      - hints: all of them, first source wins on conflicts
+    """
+    merged = {}
+
+    for src in sources:
+        if src.id not in merged:
+            merged[src.id] = src.copy(update={'hints': dict(src.hints)})
+            continue
+
+        curr = merged[src.id]
+        for attr in ('seeds', 'leechers'):
+            values = [x for x in (getattr(curr, attr), getattr(src, attr))
+                      if x is not None]
+            setattr(curr, attr, max(values) if values else None)
+
+        if src.created is not None:
+            curr.created = min(curr.created or src.created, src.created)
+
+        if curr.size is None:
+            curr.size = src.size
+
+        for (k, v) in src.hints.items():
+            curr.hints.setdefault(k, v)
+
+    ret = list(merged.values())
+
+    saved = len(sources) - len(ret)
+    if saved:
+        logmsg = "Merged %s duplicated sources"
+        logmsg = logmsg % saved
+        _logger.info(logmsg)
 
-    ret = list(filter(lambda x: x is not None, ret))
     return ret
 
 
-def _safe_analyze_one(source, type_hint=None):
+class WorkerPool:
+    """
+    Long-lived process pool for analyze().
+
+    Processes are spawned on first use and warmed up on start, so callers
+    running several analyses (i.e. one per query) only pay guessit's
+    startup cost once. close() must be called to shut down the workers.
+    """
+    # Chunks per worker: bigger chunks save IPC round trips, smaller ones
+    # balance better slow names among workers.
+    CHUNKS_PER_WORKER = 4
+
+    def __init__(self, processes=None):
+        self.processes = processes or multiprocessing.cpu_count()
+        self._pool = None
+        # Pools are shared by threads (i.e. App.aquery() analyses)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def started(self):
+        return self._pool is not None
+
+    def start(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.processes,
+                    initializer=_warm_up_worker,
+                    initargs=(_distributors,))
+
+    def chunksize(self, n_items):
+        n_chunks = self.processes * self.CHUNKS_PER_WORKER
+        return max(1, math.ceil(n_items / n_chunks))
+
+    def starmap(self, fn, args):
+        args = list(args)
+        self.start()
+
+        return self._pool.starmap(fn, args,
+                                  chunksize=self.chunksize(len(args)))
+
+    def imap_unordered(self, fn, args):
+        args = list(args)
+        self.start()
+
+        return self._pool.imap_unordered(fn, args,
+                                         chunksize=self.chunksize(len(args)))
+
+    def close(self):
+        with self._lock:
+            if self._pool is None:
+                return
+
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+# Worker for time limited parses off the main thread (see
+# _time_limit_needs_worker()). Shared by all of them and started on first
+# use, multiprocessing terminates it on exit.
+_time_limit_pool = WorkerPool(processes=1)
+
+
+def _warm_up_worker(distributors):
+    # Workers may not be forked from the parent (i.e. spawn start method),
+    # so the distributor list is passed explicitly.
+    set_distributors(distributors)
+
+    # guessit builds its rebulk rules on the first call, do it before any
+    # real work reaches the worker.
+    guessit.guessit('Warm.Up.S01E01.720p.WEB.x264-GROUP')
+
+
+def _safe_analyze_one(source, type_hint=None, cache=None, timeout=None,
+                      lazy=False):
     try:
-        return analyze_one(source, type_hint)
+        return analyze_one(source, type_hint, cache=cache, timeout=timeout,
+                           lazy=lazy)
     except NormalizationError:
         logmsg = "Error analyzing '%s'"
         logmsg = logmsg % source.name
         _logger.warning(logmsg)
 
 
-def analyze_one(source, type_hint=None):
+def _safe_parse_item(item):
+    idx, name, type_hint, timeout = item
+    return (idx, _safe_parse(name, type_hint, timeout))
+
+
+def _safe_parse(name, type_hint=None, timeout=None):
+    # Errors are returned instead of raised so they can be stored in a
+    # ParseCache and sent back from pool workers. Both need picklable values
+    # (guessit's MatchesDict and errors built from it are not).
+    # Metadata is kept lazy here, it's smaller to pickle and store.
+    # _build_analyzed_source() turns it into a dict if needed.
+    if timeout and _time_limit_needs_worker():
+        [(idx, res)] = _time_limit_pool.imap_unordered(
+            _safe_parse_item, [(0, name, type_hint, timeout)])
+        return res
+
+    try:
+        with _time_limit(timeout, name):
+            entity, metadata, other = parse(name, type_hint, lazy=True)
+    except NormalizationError as e:
+        return e.__class__(str(e))
+
+    return (entity, metadata, dict(other))
+
+
+def _time_limit_needs_worker():
+    # Time limits use SIGALRM, which can only be handled from the main
+    # thread. Other threads (i.e. App.aquery() analyses) must parse in pool
+    # workers, which are single-threaded processes. Platforms without
+    # SIGALRM have no time limits at all.
+    return (hasattr(signal, 'SIGALRM') and
+            threading.current_thread() is not threading.main_thread())
+
+
+@contextlib.contextmanager
+def _time_limit(seconds, name):
+    if (not seconds or
+            not hasattr(signal, 'SIGALRM') or
+            threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+
+    def _handler(signum, frame):
+        msg = "'%s' took longer than %ss to parse"
+        msg = msg % (name, seconds)
+        raise AnalysisTimeoutError(msg)
+
+    # Any timer set by the caller is suspended and then re-armed with the
+    # time it had left (overdue ones fire right away)
+    prev_handler = signal.signal(signal.SIGALRM, _handler)
+    prev_delay, prev_interval = signal.setitimer(signal.ITIMER_REAL, seconds)
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, prev_handler)
+        if prev_delay:
+            prev_delay = max(prev_delay - (time.monotonic() - t0), 1e-6)
+            signal.setitimer(signal.ITIMER_REAL, prev_delay, prev_interval)
+
+
+def analyze_one(source, type_hint=None, cache=None, timeout=None,
+                lazy=False):
     type_hint = type_hint or source.hints.get('type')
 
-    entity, metadata, other = parse(source.name, type_hint)
+    try:
+        parsed = _quarantine[(source.name, type_hint)]
+    except KeyError:
+        if cache is None:
+            parsed = _safe_parse(source.name, type_hint, timeout)
+            _store_parsed(source.name, type_hint, parsed, None)
+
+        else:
+            try:
+                parsed = cache.get(source.name, type_hint)
+            except CacheKeyError:
+                parsed = _safe_parse(source.name, type_hint, timeout)
+                _store_parsed(source.name, type_hint, parsed, cache)
+
+    if isinstance(parsed, NormalizationError):
+        raise parsed
+
+    return _build_analyzed_source(source, parsed, lazy)
+
+
+def _build_analyzed_source(source, parsed, lazy=False):
+    entity, metadata, other = parsed
+    if not lazy:
+        metadata = dict(metadata)
+
     params = source.dict()
     params.update({
         'entity': entity,
@@ -123,23 +617,240 @@ def analyze_one(source, type_hint=None):
     return schema.Source(**params)
 
 
-def parse(name, type_hint=None):
+def fast_parse(name, type_hint=None):
+    """
+    Parse common scene names like
+    'Series.Name.S01E02.The.Long.Night.1080p.AMZN.WEB-DL.DDP5.1.H.264-GROUP'
+    or 'Movie.Title.2019.720p.BluRay.x264-GROUP' without guessit.
+
+    Returns a dict with the same data guessit would return or None if the
+    name doesn't match any of the known shapes exactly.
+    """
+    for (type, regexp) in (('episode', _FAST_EPISODE_RE),
+                           ('movie', _FAST_MOVIE_RE)):
+        m = regexp.search(name)
+        if m:
+            break
+    else:
+        return None
+
+    if type_hint and type_hint != type:
+        return None
+
+    words = m.group('title').split('.')
+    following = m.group('year') or 's' + m.group('season')
+    if (any(_is_unsafe_word(w) for w in words) or
+            _guessit_vocabulary()[0].search(m.group('title')) or
+            _is_guessit_junction(words[-1].lower(), following)):
+        return None
+
+    ret = {'title': ' '.join(words)}
+    if m.group('year'):
+        ret['year'] = int(m.group('year'))
+    if type == 'episode':
+        ret['season'] = int(m.group('season'))
+        if m.group('episode'):
+            ret['episode'] = int(m.group('episode'))
+
+    tail = m.group('tail')
+    pos = 0
+    tags = []
+    episode_title = []
+    while pos < len(tail):
+        tag = _FAST_TAG_RE.match(tail, pos)
+        if tag:
+            if tag.group('audio'):
+                tags.extend([
+                    ('audio_codec',
+                     FAST_PARSE_AUDIO_CODECS[tag.group('audio').lower()]),
+                    ('audio_channels', tag.group('channels'))
+                ])
+            else:
+                tags.extend(FAST_PARSE_TOKENS[tag.group('token').lower()])
+
+            pos = tag.end()
+            continue
+
+        # Words between the episode and the first tag are its title
+        word = _FAST_WORD_RE.match(tail, pos)
+        if word and not tags and 'episode' in ret:
+            if _is_unsafe_word(word.group('word')):
+                return None
+
+            episode_title.append(word.group('word'))
+            pos = word.end()
+            continue
+
+        group = _FAST_GROUP_RE.match(tail, pos)
+        if not group:
+            return None
+
+        # Groups named as tags (-WEB, -HDTV) change how guessit reads the
+        # tags before them
+        if group.group('release_group').lower() in FAST_PARSE_TOKENS:
+            return None
+
+        ret['release_group'] = group.group('release_group')
+        if group.group('container'):
+            container = group.group('container').lower()
+            ret['container'] = container
+            ret['mimetype'] = FAST_PARSE_CONTAINERS[container]
+
+        break
+
+    # An episode title must be followed by tags, guessit can't tell where
+    # it ends otherwise
+    if episode_title:
+        if (not tags or
+                _guessit_vocabulary()[0].search('.'.join(episode_title))):
+            return None
+
+        ret['episode_title'] = ' '.join(episode_title)
+
+    # Repeated tags (i.e. an episode titled 'Web' before WEB) are read by
+    # guessit as something else
+    other = []
+    for (key, value) in tags:
+        if key == 'other':
+            if value in other:
+                return None
+            other.append(value)
+        elif key in ret:
+            return None
+        else:
+            ret[key] = value
+
+    if other:
+        ret['other'] = other if len(other) > 1 else other[0]
+
+    ret['type'] = type
+    return ret
+
+
+def _guessit_vocabulary():
+    # Everything guessit may take as something else than a title, straight
+    # from its rules so nothing is missed:
+    #   - a regexp for the words and phrases found by its patterns (strings,
+    #     regexps and chain parts)
+    #   - episode details and video codecs ('Final', 'DivX'...), found even
+    #     inside words ('Finale')
+    #   - a regexp for the ones that can span a separator, matched at the
+    #     end of a string ('Mpeg.2' in 'ReMpeg.2019')
+    #   - affixes that make a word a language when glued to one ('Subfr')
+    global _fast_vocabulary
+
+    if _fast_vocabulary is not None:
+        return _fast_vocabulary
+
+    def _iter_patterns(patterns):
+        for pattern in patterns:
+            if hasattr(pattern, 'parts'):
+                yield from _iter_patterns([x.pattern for x in pattern.parts])
+            else:
+                yield pattern
+
+    api = guessit.api.default_api
+    api.configure({})
+
+    alternatives = []
+    spanning = []
+    inner = []
+    for pattern in _iter_patterns(api.rebulk.effective_patterns()):
+        for x in getattr(pattern, 'patterns', []):
+            if isinstance(x, str):
+                if pattern.name in ('episode_details', 'video_codec'):
+                    inner.append(x.lower())
+                alternatives.append(re.escape(x))
+                if not x.isalnum():
+                    spanning.append(re.escape(x))
+            elif hasattr(x, 'pattern'):
+                # Group names are repeated among patterns
+                x = re.sub(r'\(\?P<\w+>', '(?:', x.pattern)
+                alternatives.append(x)
+                spanning.append(x)
+
+    config = api.advanced_config['language']
+    prefixes = (config['subtitle_affixes'] + config['subtitle_prefixes'] +
+                config['language_affixes'] + config['language_prefixes'])
+    suffixes = (config['subtitle_affixes'] + config['subtitle_suffixes'] +
+                config['language_affixes'] + config['language_suffixes'])
+
+    regexp = re.compile(
+        r'(?<![a-z0-9])(?:' + '|'.join(alternatives) + r')(?![a-z0-9])',
+        re.IGNORECASE)
+    spanning = re.compile('(?:' + '|'.join(spanning) + ')$', re.IGNORECASE)
+    _fast_vocabulary = (regexp, spanning, inner, prefixes, suffixes)
+    return _fast_vocabulary
+
+
+@functools.lru_cache(maxsize=1024)
+def _is_guessit_junction(word, following):
+    # True if guessit may find something starting inside the last word of
+    # the title and ending in what follows it
+    spanning = _guessit_vocabulary()[1]
+    string = word + '.' + following
+    for end in range(len(word) + 2, len(string) + 1):
+        m = spanning.search(string, 0, end)
+        if m and m.start() < len(word):
+            return True
+
+    return False
+
+
+def _is_guessit_word(word):
+    regexp, _, inner, prefixes, suffixes = _guessit_vocabulary()
+    word = word.lower()
+
+    # Plurals too, some are split ('Hists' as HIST plus TS)
+    if regexp.fullmatch(word) or (word.endswith('s') and
+                                  regexp.fullmatch(word[:-1])):
+        return True
+
+    if any(x in word for x in inner):
+        return True
+
+    return (
+        any(word.startswith(x) and word[len(x):] in _FAST_LANGUAGE_WORDS
+            for x in prefixes) or
+        any(word.endswith(x) and word[:-len(x)] in _FAST_LANGUAGE_WORDS
+            for x in suffixes))
+
+
+def _is_unsafe_word(word):
+    # Words guessit may not take as part of a title: known tokens, language
+    # and country codes or names (us, Eng, ITA, french...), any other three
+    # letter uppercase word (DTS, SUB, FBI...) and anything in guessit's own
+    # vocabulary
+    if word.lower() in FAST_PARSE_UNSAFE_WORDS:
+        return True
+
+    if word.lower() in _FAST_LANGUAGE_WORDS:
+        return True
+
+    if len(word) == 3 and word.isupper():
+        return True
+
+    return _is_guessit_word(word)
+
+
+def parse(name, type_hint=None, fast=True, lazy=False):
     # We preprocess name to extract distributors
     # (distributors != release-teams)
     release_distributors = set()
-    for dist in KNOWN_DISTRIBUTORS:
-        tag = '[' + dist + ']'
-        idx = name.lower().find(tag)
-        if idx == -1:
-            continue
 
-        name = (name[:idx] + name[idx+len(tag):]).strip()
-        release_distributors.add(dist)
+    def _extract_distributor(m):
+        release_distributors.add(m.group(1).lower())
+        return ''
 
-    try:
-        parsed = guessit.guessit(name, options={'type': type_hint})
-    except guessit.api.GuessitException as e:
-        raise ParseError() from e
+    if _distributors_re is not None:
+        name = _distributors_re.sub(_extract_distributor, name).strip()
+
+    parsed = fast_parse(name, type_hint) if fast else None
+    if parsed is None:
+        try:
+            parsed = guessit.guessit(name, options={'type': type_hint})
+        except guessit.api.GuessitException as e:
+            raise ParseError() from e
 
     # Fixes: Insert distributors again
     if release_distributors:
@@ -165,7 +876,9 @@ def parse(name, type_hint=None):
         logmsg = logmsg % (name, e)
         _logger.warning(logmsg)
 
-    metadata = extract_items(parsed, METADATA_RULES)
+    metadata = LazyMetadata(parsed)
+    if not lazy:
+        metadata = dict(metadata)
 
     return (entity, metadata, parsed)
 
@@ -213,6 +926,75 @@ def parse(name, type_hint=None):
     #             del info['language']
 
 
+def set_distributors(distributors):
+    """
+    Set the distributor tags stripped from names by parse() and reported as
+    'release_distributors' (i.e. 'eztv' for names like 'Foo.S01E01[eztv]').
+
+    Accepts any iterable of tags or a comma separated string. Tags are
+    compiled into a single case-insensitive regexp so every tag is stripped
+    in one pass regardless of how many tags there are.
+    """
+    global _distributors, _distributors_re
+
+    if isinstance(distributors, str):
+        distributors = distributors.split(',')
+
+    _distributors = sorted(set([x.strip().lower() for x in distributors
+                                if x.strip()]))
+    if not _distributors:
+        _distributors_re = None
+        return
+
+    # Longer tags first so a tag that is a prefix of another can't win
+    alternatives = sorted(_distributors, key=lambda x: (-len(x), x))
+    alternatives = '|'.join([re.escape(x) for x in alternatives])
+    _distributors_re = re.compile(r'\[(' + alternatives + r')\]',
+                                  re.IGNORECASE)
+
+
+set_distributors(KNOWN_DISTRIBUTORS)
+
+
+def version_stamp():
+    rules = [rule[:2] for rule in METADATA_RULES]
+    data = repr((PARSER_VERSION, guessit.__version__, rules,
+                 _distributors))
+
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class ParseCache:
+    """
+    Persistent memo for parse() results on top of any services.cache backend.
+
+    Entries are stamped with version_stamp() so they are discarded when
+    guessit, METADATA_RULES or the parser itself change.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.stamp = version_stamp()
+
+    def encode_key(self, name, type_hint):
+        return (type_hint or '') + '\0' + name
+
+    def get(self, name, type_hint=None):
+        key = self.encode_key(name, type_hint)
+        stamp, value = self.backend.get(key)
+        if stamp != self.stamp:
+            self.backend.delete(key)
+            raise CacheKeyExpiredError(key)
+
+        return pickle.loads(value)
+
+    def set(self, name, type_hint, value):
+        # Value is pickled here, and not by the backend, so an stale entry
+        # can be identified by its stamp without unpickling objects from an
+        # incompatible guessit version.
+        key = self.encode_key(name, type_hint)
+        self.backend.set(key, (self.stamp, pickle.dumps(value)))
+
+
 def extract_entity(info, type=None):
     type_candidates = [type, info.get('type')]
     type_candidates = [x for x in type_candidates if x]
@@ -282,6 +1064,69 @@ def extract_items(orig, rules):
     return ret
 
 
+class LazyMetadata(schema.Metadata):
+    """
+    Compact, read-only alternative to the metadata dict built from
+    METADATA_RULES.
+
+    Only raw guessit values are stored: a bitmask of the rules present plus
+    a tuple with their values. Keys are converted (and rule functions
+    applied) on access.
+    """
+    __slots__ = ('_mask', '_values')
+
+    def __init__(self, parsed):
+        # Like extract_items(), known keys are popped from parsed
+        mask = 0
+        values = []
+        for (idx, (src, dst, fn)) in enumerate(_METADATA_RULES):
+            if src in parsed:
+                mask |= 1 << idx
+                values.append(parsed.pop(src))
+
+        self._mask = mask
+        self._values = tuple(values)
+
+    def __getitem__(self, key):
+        idx = _METADATA_RULES_INDEX[key]
+        bit = 1 << idx
+        if not self._mask & bit:
+            raise KeyError(key)
+
+        value = self._values[bin(self._mask & (bit - 1)).count('1')]
+        fn = _METADATA_RULES[idx][2]
+
+        return fn(value) if fn else value
+
+    def __iter__(self):
+        for (idx, (src, dst, fn)) in enumerate(_METADATA_RULES):
+            if self._mask & (1 << idx):
+                yield dst
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return f"<LazyMetadata {dict(self)!r}>"
+
+    def __reduce__(self):
+        return (_rebuild_lazy_metadata, (self._mask, self._values))
+
+
+def _rebuild_lazy_metadata(mask, values):
+    ret = LazyMetadata.__new__(LazyMetadata)
+    ret._mask = mask
+    ret._values = values
+
+    return ret
+
+
+_METADATA_RULES = [rule if len(rule) == 3 else rule + (None,)
+                   for rule in METADATA_RULES]
+_METADATA_RULES_INDEX = {rule[1]: idx
+                         for (idx, rule) in enumerate(_METADATA_RULES)}
+
+
 class NormalizationError(Exception):
     pass
 
@@ -294,4 +1139,8 @@ class ParseError(NormalizationError):
     pass
 
 
+class AnalysisTimeoutError(NormalizationError):
+    pass
+
+
 _logger = logging.getLogger('analyze')
@@ -19,6 +19,7 @@
 
 
 import argparse
+import asyncio
 import logging
 import os
 
@@ -63,6 +64,9 @@ class App:
         network_cache_path = appdirs.user_cache_dir() + "/arroyo/network"
         os.makedirs(network_cache_path, exist_ok=True)
 
+        analysis_cache_path = appdirs.user_cache_dir() + "/arroyo/analysis"
+        os.makedirs(analysis_cache_path, exist_ok=True)
+
         # Setup core
         self.srvs = Services(
             logger=logger,
@@ -79,6 +83,21 @@ class App:
                 delta=self.srvs.settings.get("cache.delta"),
             )
 
+        analyze.set_distributors(
+            self.srvs.settings.get("analyze.distributors",
+                                   analyze.KNOWN_DISTRIBUTORS)
+        )
+
+        # Parse results don't expire, they are invalidated by their version
+        # stamp (see analyze.ParseCache)
+        self.analysis_cache = None
+        if self.srvs.settings.get("analyze.cache.enabled"):
+            self.analysis_cache = analyze.ParseCache(
+                cache.DiskCache(basedir=analysis_cache_path, delta=-1)
+            )
+
+        self.analysis_pool = analyze.WorkerPool()
+
         # Setup engines
         self.scraper = scraper.Engine(self.srvs)
         self.filters = query.Engine(self.srvs)
@@ -86,30 +105,66 @@ class App:
 
     def query(self, q, provider=None, uri=None):
         filterctx = self.filters.build_filter_context(q)
+        scrapectxs = self._scrape_contexts(q, provider, uri)
+        sources = self.scraper.process(*scrapectxs)
+
+        return self._analyze_and_filter(q, filterctx, sources)
 
-        # Build scraper contexts
+    async def aquery(self, q, provider=None, uri=None, executor=None):
+        """
+        Async version of query() to run in an existing event loop, i.e. to
+        run several queries concurrently.
+
+        Analysis and filtering are CPU bound, they run in executor (the
+        loop's default executor if None). Use aclose() to release the
+        resources used from the loop.
+        """
+        filterctx = self.filters.build_filter_context(q)
+        scrapectxs = self._scrape_contexts(q, provider, uri)
+        sources = await self.scraper.aprocess(*scrapectxs)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, self._analyze_and_filter, q, filterctx, sources)
+
+    def _scrape_contexts(self, q, provider, uri):
         if provider or uri:
-            scrapectxs = [
+            return [
                 self.scraper.build_context(provider=provider, uri=uri)
             ]
-        else:
-            scrapectxs = self.scraper.build_contexts_for_query(q)
 
-        results = self.scraper.process(*scrapectxs)
-        results = analyze.analyze(*results, mp=False)
+        skipped = []
+        ctxs = self.scraper.build_contexts_for_query(q, skipped=skipped)
+
+        if skipped:
+            msg = "Skipping providers known to be down: %s"
+            msg = msg % ", ".join(skipped)
+            print(msg)
+
+        return ctxs
 
-        if not results:
+    def _analyze_and_filter(self, q, filterctx, sources):
+        sources = analyze.dedup(*sources)
+        if not sources:
             msg = "No results found for %r"
             msg = msg % q
             print(msg)
             return
 
         msg = "Found %s sources"
-        msg = msg % (len(results),)
+        msg = msg % (len(sources),)
         print(msg)
 
-        # Filter results
-        results = self.filters.apply(filterctx, results)
+        # Analyze and filter results as they come
+        results = analyze.analyze_iter(
+            *sources,
+            mp=self.srvs.settings.get("analyze.multiprocessing"),
+            cache=self.analysis_cache,
+            pool=self.analysis_pool,
+            timeout=float(self.srvs.settings.get("analyze.timeout")),
+            lazy=self.srvs.settings.get("analyze.lazy-metadata"),
+        )
+        results = list(self.filters.apply(filterctx, results))
         msg = "Got %s matching sources for %r"
         msg = msg % (len(results), q)
         print(msg)
@@ -117,6 +172,14 @@ class App:
         groups = self.filters.sort(results)
         return groups
 
+    def close(self):
+        self.analysis_pool.close()
+        self.scraper.close()
+
+    async def aclose(self):
+        await self.scraper.aclose()
+        self.close()
+
     def download(self, source):
         self.downloads.add(source)
 
@@ -183,7 +246,7 @@ class LogFormatter(logging.Formatter):
 class Settings(settings.Settings):
     def get(self, key, default=settings.UNDEF):
         if default == settings.UNDEF:
-            default = defaults.SETTINGS.get(key) or settings.UNDEF
+            default = defaults.SETTINGS.get(key, settings.UNDEF)
 
         ret = super().get(key, default=default)
         return ret
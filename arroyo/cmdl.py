@@ -46,4 +46,7 @@ def main():
 
     app = application.App(log_level=loglevel, settings_path=args.settings,
                           database_path=args.db)
-    app.run_command_line(sys.argv[1:], parser=parser)
+    try:
+        app.run_command_line(sys.argv[1:], parser=parser)
+    finally:
+        app.close()
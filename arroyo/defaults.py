@@ -31,8 +31,20 @@ LOG_FORMAT = "[%(levelname)s] [%(name)s] %(message)s"
 
 
 KEY_SCRAPER_MAX_PARALEL_REQUESTS = 'fetch.max-paralel-requests'
+KEY_SCRAPER_MAX_PARALEL_REQUESTS_PER_HOST = (
+    'fetch.max-paralel-requests-per-host')
 KEY_SCRAPER_TIMEOUT = 'fetch.timeout'
+KEY_SCRAPER_CONNECTIONS_PER_HOST = 'fetch.connections-per-host'
+KEY_SCRAPER_KEEPALIVE_TIMEOUT = 'fetch.keepalive-timeout'
+KEY_SCRAPER_DNS_CACHE_TTL = 'fetch.dns-cache-ttl'
 KEY_SCRAPER_UA = 'fetch.user-agent'
+KEY_SCRAPER_RETRY_ATTEMPTS = 'fetch.retry-attempts'
+KEY_SCRAPER_HEDGE = 'fetch.hedge'
+KEY_SCRAPER_CACHE_COMPRESSION = 'fetch.cache-compression'
+KEY_SCRAPER_CIRCUIT_FAILURES = 'fetch.circuit-failures'
+KEY_SCRAPER_CIRCUIT_COOLDOWN = 'fetch.circuit-cooldown'
+KEY_PARSE_EXECUTOR = 'parse.executor'
+KEY_HTML_PARSER = 'parse.html-parser'
 
 
 SETTINGS = {
@@ -42,10 +54,26 @@ SETTINGS = {
     'cache.enabled': True,
     'cache.delta': 60*60,
 
+    'analyze.cache.enabled': True,
+    'analyze.multiprocessing': True,
+    'analyze.timeout': 5,
+    'analyze.lazy-metadata': False,
+
     KEY_SCRAPER_UA: ('Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:69.0) '
                      'Gecko/20100101 Firefox/69.0'),
     KEY_SCRAPER_TIMEOUT: 15,
-    KEY_SCRAPER_MAX_PARALEL_REQUESTS: 5,
+    KEY_SCRAPER_MAX_PARALEL_REQUESTS: 10,
+    KEY_SCRAPER_MAX_PARALEL_REQUESTS_PER_HOST: 4,
+    KEY_SCRAPER_CONNECTIONS_PER_HOST: 4,
+    KEY_SCRAPER_KEEPALIVE_TIMEOUT: 30,
+    KEY_SCRAPER_DNS_CACHE_TTL: 300,
+    KEY_SCRAPER_RETRY_ATTEMPTS: 3,
+    KEY_SCRAPER_HEDGE: False,
+    KEY_SCRAPER_CACHE_COMPRESSION: 'zlib',
+    KEY_SCRAPER_CIRCUIT_FAILURES: 3,
+    KEY_SCRAPER_CIRCUIT_COOLDOWN: 600,
+    KEY_PARSE_EXECUTOR: 'threads',
+    KEY_HTML_PARSER: 'lxml',
 
     'plugin.transmission.host': 'localhost',
     'plugin.transmission.port': '9091',
@@ -19,12 +19,14 @@
 
 
 import abc
+import codecs
 import fnmatch
+import logging
 import re
 import typing
 
 import bs4
-from arroyo import schema
+from arroyo import defaults, schema
 
 
 class Extension:
@@ -51,11 +53,64 @@ class CommandUsageError(ExtensionError):
     pass
 
 
+class Response:
+    """
+    Result of Provider.fetch(): body plus the bits of the HTTP response the
+    scraper needs for decoding and cache revalidation.
+
+    body is the raw content (bytes) or None on 304 responses. charset is the
+    one declared in the Content-Type header, if any.
+    """
+    def __init__(self, body, status=200, headers=None, charset=None):
+        self.body = body
+        self.status = status
+        self.headers = headers if headers is not None else {}
+        self.charset = charset
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified')
+
+
 class Provider(Extension):
     DEFAULT_URI: str
     URI_GLOBS: typing.List[str] = []
     URI_REGEXPS: typing.List[str] = []
 
+    # bs4 tree builder for parse_as_soup(), overrides the global
+    # 'parse.html-parser' setting
+    HTML_PARSER: typing.Optional[str] = None
+
+    # Part of the document built by parse_as_soup() (i.e. the results
+    # table), None to build the whole document
+    PARSE_ONLY: typing.Optional[bs4.SoupStrainer] = None
+
+    # Request limits for the provider's host, see scraper.HostLimiter:
+    # 'max-in-flight', 'rate', 'burst' and 'min-interval'. max-in-flight
+    # defaults to the 'fetch.max-paralel-requests-per-host' setting
+    RATE_LIMIT: typing.Dict[str, float] = {}
+
+    # Retry policy for the provider's requests, see scraper.RetryPolicy:
+    # 'attempts', 'backoff', 'max-backoff', 'jitter', 'retry-on' and
+    # 'hedge'. attempts and hedge default to the 'fetch.retry-attempts' and
+    # 'fetch.hedge' settings
+    RETRY: typing.Dict[str, typing.Any] = {}
+
+    # Base URIs (scheme and host) of mirrors serving the same paths, the
+    # scraper sends requests for URIs on any of them to the best one (see
+    # scraper.MirrorSelector)
+    MIRRORS: typing.List[str] = []
+
+    # Encoding of the provider's pages, skips charset sniffing in decode()
+    ENCODING: typing.Optional[str] = None
+
+    # parse() gets raw bytes instead of decoded text
+    PARSE_BYTES: bool = False
+
     @classmethod
     def can_handle(cls, url):
         for glob in cls.URI_GLOBS:
@@ -71,15 +126,42 @@ class Provider(Extension):
     def paginate(self, url):
         yield url
 
-    async def fetch(self, sess, uri):
-        async with sess.get(uri) as resp:
-            return await resp.text()
+    async def fetch(self, sess, uri, headers=None):
+        async with sess.get(uri, headers=headers) as resp:
+            # Read bytes, resp.text() runs charset detection over the whole
+            # body if the server doesn't declare it. See decode()
+            if resp.status == 304:
+                body = None
+            else:
+                body = await resp.read()
+
+            return Response(body, status=resp.status, headers=resp.headers,
+                            charset=resp.charset)
+
+    def decode(self, content, charset=None):
+        """
+        Decode fetched content using, in order: ENCODING, charset (from
+        response headers), the encoding found by sniff_encoding() or UTF-8.
+        """
+        encoding = self.ENCODING or charset or sniff_encoding(content)
+
+        try:
+            return content.decode(encoding or 'utf-8', errors='replace')
+        except LookupError:
+            return content.decode('utf-8', errors='replace')
 
     def parse(self, buffer):
         return []
 
+    @property
+    def html_parser(self):
+        return self.HTML_PARSER or self.srvs.settings.get(
+            defaults.KEY_HTML_PARSER,
+            defaults.SETTINGS[defaults.KEY_HTML_PARSER])
+
     def parse_as_soup(self, buffer):
-        return bs4.BeautifulSoup(buffer, "html.parser")
+        return build_soup(buffer, self.html_parser,
+                          parse_only=self.PARSE_ONLY)
 
     def get_query_uri(self, query):
         return None
@@ -89,6 +171,71 @@ class IncompatibleQueryError(Exception):
     pass
 
 
+# Always available, it's part of the standard library
+FALLBACK_HTML_PARSER = "html.parser"
+
+# How much of the content sniff_encoding() looks into
+SNIFF_SIZE = 2048
+
+_BOMS = (
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+_SNIFF_RE = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-z0-9_.:-]+)|'
+    rb'^<\?xml[^>]+encoding\s*=\s*["\']([a-z0-9_.:-]+)',
+    re.IGNORECASE)
+
+_missing_html_parsers = set()
+
+
+def sniff_encoding(content):
+    """
+    Cheap encoding detection from a BOM, <meta charset> (or http-equiv) tag
+    or XML declaration in the first SNIFF_SIZE bytes. Returns None if none
+    is found.
+    """
+    for (bom, encoding) in _BOMS:
+        if content.startswith(bom):
+            return encoding
+
+    m = _SNIFF_RE.search(content[:SNIFF_SIZE])
+    if not m:
+        return None
+
+    return (m.group(1) or m.group(2)).decode('ascii').lower()
+
+
+def build_soup(buffer, parser, parse_only=None):
+    """
+    Build a BeautifulSoup tree with the parser (bs4 tree builder) name, i.e.
+    'lxml' or 'html5lib'. If parse_only (a bs4.SoupStrainer) is given only
+    matching elements are added to the tree.
+
+    If the parser is not installed (or unknown to bs4) FALLBACK_HTML_PARSER
+    is used instead. This is logged only once per parser.
+    """
+    # html5lib always builds the whole document (and bs4 warns about it)
+    if parser == 'html5lib':
+        parse_only = None
+
+    if parser not in _missing_html_parsers:
+        try:
+            return bs4.BeautifulSoup(buffer, parser, parse_only=parse_only)
+        except bs4.FeatureNotFound:
+            _missing_html_parsers.add(parser)
+
+            logmsg = "HTML parser '%s' not available, using '%s'"
+            logmsg = logmsg % (parser, FALLBACK_HTML_PARSER)
+            _logger.warning(logmsg)
+
+    return bs4.BeautifulSoup(buffer, FALLBACK_HTML_PARSER,
+                             parse_only=parse_only)
+
+
 class Filter(Extension):
     HANDLES: typing.List[str] = []
 
@@ -157,3 +304,6 @@ class Downloader(Extension):
         In case of error a ExtensionError should be raised.
         """
         raise NotImplementedError()
+
+
+_logger = logging.getLogger("arroyo.extensions")
@@ -19,8 +19,18 @@
 
 
 import argparse
+import hashlib
 import json
+import logging
+import multiprocessing
+import pathlib
+import platform
 import sys
+import tempfile
+import time
+from collections import abc
+
+import guessit
 
 from arroyo import (
     analyze,
@@ -31,6 +41,11 @@ from arroyo import (
     scraper,
     services,
 )
+from arroyo.services import cache
+
+
+# Recorded provider samples, only available on source checkouts
+SAMPLES_PATH = pathlib.Path(__file__).parents[3] / "tests" / "samples"
 
 
 class Command(extensions.Command):
@@ -80,6 +95,14 @@ class Command(extensions.Command):
         scrape_cmd.add_argument("--provider", required=True)
         scrape_cmd.add_argument("--uri", help="URI to parse"),
         scrape_cmd.add_argument("--iterations", default=1, type=int)
+        scrape_cmd.add_argument(
+            "--incremental",
+            action="store_true",
+            help=(
+                "Stop before --iterations pages if there is nothing new "
+                "since the last incremental scrape"
+            ),
+        )
         scrape_cmd.add_argument(
             "-o", "--output", type=argparse.FileType("w"), default=sys.stdout
         )
@@ -151,6 +174,29 @@ class Command(extensions.Command):
         download_cmd.add_argument("--add", action="store_true")
         download_cmd.add_argument("--list", action="store_true")
 
+        #
+        # bench
+        #
+        bench_cmd = subcmds.add_parser(
+            "bench", help="Run benchmarks and dump results as JSON"
+        )
+        bench_cmd.add_argument(dest="target", choices=["analyze"])
+        bench_cmd.add_argument(
+            "--samples",
+            type=pathlib.Path,
+            default=SAMPLES_PATH,
+            help="Directory with recorded samples (*.json and *.html)",
+        )
+        bench_cmd.add_argument(
+            "--processes",
+            type=int,
+            default=multiprocessing.cpu_count(),
+            help="Worker processes for multiprocessing modes",
+        )
+        bench_cmd.add_argument(
+            "-o", "--output", type=argparse.FileType("w"), default=sys.stdout
+        )
+
     def run(self, app, args):
         if args.devcmd == "fetch":
             self.run_fetch(app, args)
@@ -176,6 +222,9 @@ class Command(extensions.Command):
         elif args.devcmd == "download":
             self.run_download(app, args)
 
+        elif args.devcmd == "bench":
+            self.run_bench(app, args)
+
         elif not args.devcmd:
             raise extensions.CommandUsageError()
 
@@ -186,13 +235,13 @@ class Command(extensions.Command):
         if not args.provider and not args.uri:
             raise extensions.CommandUsageError()
 
-        engine = scraper.Engine(app.srvs)
+        engine = app.scraper
         ctx = engine.build_context(args.provider, args.uri)
         result = engine.fetch_one(ctx)
         args.output.write(result)
 
     def run_parse(self, app, args):
-        engine = scraper.Engine(app.srvs)
+        engine = app.scraper
         ctx = engine.build_context(
             provider=args.provider, type=args.type, language=args.language
         )
@@ -207,15 +256,25 @@ class Command(extensions.Command):
         if not args.provider and not args.uri:
             raise extensions.CommandUsageError()
 
-        engine = scraper.Engine(app.srvs)
-        ctxs = engine.build_n_contexts(
-            args.iterations,
-            args.provider,
-            args.uri,
-            type=args.type,
-            language=args.language,
-        )
-        results = engine.process(*ctxs)
+        engine = app.scraper
+        if args.incremental:
+            ctx = engine.build_context(
+                args.provider,
+                args.uri,
+                type=args.type,
+                language=args.language,
+            )
+            results = engine.process_incremental(ctx, args.iterations)
+
+        else:
+            ctxs = engine.build_n_contexts(
+                args.iterations,
+                args.provider,
+                args.uri,
+                type=args.type,
+                language=args.language,
+            )
+            results = engine.process(*ctxs)
 
         output = json.dumps([x.dict() for x in results], indent=2)
         args.output.write(output)
@@ -226,7 +285,9 @@ class Command(extensions.Command):
             raw = [raw]
 
         raw = [schema.Source(**x) for x in raw]
-        proc = analyze.analyze(*raw, mp=False)
+        proc = analyze.analyze(
+            *raw, mp=False, cache=app.analysis_cache,
+            timeout=float(app.srvs.settings.get("analyze.timeout")))
 
         output = json.dumps(
             [x.dict() for x in proc], indent=2, default=_json_encode_hook
@@ -369,6 +430,151 @@ class Command(extensions.Command):
         else:
             raise extensions.CommandUsageError()
 
+    def run_bench(self, app, args):
+        names = sample_names(app.scraper, args.samples)
+        if not names:
+            errmsg = "No names found in '%s'"
+            errmsg = errmsg % args.samples
+            print(errmsg, file=sys.stderr)
+            raise extensions.CommandUsageError()
+
+        # Analysis errors are expected with some names, don't flood output
+        analyze_logger = logging.getLogger("analyze")
+        prev_level = analyze_logger.level
+        analyze_logger.setLevel(logging.CRITICAL)
+        try:
+            results = bench_analyze(names, processes=args.processes)
+        finally:
+            analyze_logger.setLevel(prev_level)
+
+        output = json.dumps(results, indent=2)
+        args.output.write(output)
+
+
+def sample_names(engine, path):
+    """
+    Source names from recorded samples in path, without duplicates.
+
+    '*-parsed.json' files are lists of sources, any other '*.json' or
+    '*.html' file is parsed with engine by the provider named after its
+    prefix (i.e. 'eztv-listing.html' by 'eztv').
+    """
+    names = []
+
+    for filepath in sorted(path.iterdir()):
+        if filepath.suffix not in (".json", ".html"):
+            continue
+
+        buffer = filepath.read_text(encoding="utf-8")
+        if filepath.stem.endswith("-parsed"):
+            names.extend([x["name"] for x in json.loads(buffer)])
+            continue
+
+        provider = filepath.stem.split("-")[0]
+        try:
+            ctx = engine.build_context(provider=provider)
+        except services.loader.ClassNotFoundError:
+            continue
+
+        names.extend([x.name for x in engine.parse_one(ctx, buffer)])
+
+    return list(dict.fromkeys(names))
+
+
+def bench_analyze(names, processes=None):
+    """
+    Run names through analyze.analyze() in each analysis mode:
+
+      - serial: mp=False
+      - mp-cold: mp=True with a new WorkerPool, startup included. Startup
+        (spawning workers and running a warm-up task on each) is also
+        reported on its own as startup_s
+      - mp-warm: mp=True with an already started WorkerPool
+      - cached: serial, all names already in a disk based ParseCache
+
+    Per name latency (p50/p99) is measured for serial and cached modes, in
+    multiprocessing modes names are parsed concurrently.
+    """
+    def _build_source(name):
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()
+        uri = "magnet:?xt=urn:btih:" + digest
+        return schema.Source(name=name, uri=uri, provider="bench")
+
+    def _timed(fn):
+        t0 = time.perf_counter()
+        fn()
+        return time.perf_counter() - t0
+
+    def _mode_result(wall, latencies=None):
+        ret = {
+            "wall_s": wall,
+            "names_per_s": len(sources) / wall,
+        }
+        if latencies:
+            latencies = sorted(latencies)
+            ret.update({
+                "p50_ms": _percentile(latencies, 50) * 1000,
+                "p99_ms": _percentile(latencies, 99) * 1000,
+            })
+
+        return ret
+
+    def _serial(cache=None):
+        return [_timed(lambda: analyze.analyze(src, mp=False, cache=cache))
+                for src in sources]
+
+    def _start(pool):
+        pool.start()
+        analyze.analyze(*sources[:pool.processes], mp=True, pool=pool)
+
+    sources = [_build_source(name) for name in names]
+    processes = processes or multiprocessing.cpu_count()
+    modes = {}
+
+    latencies = _serial()
+    modes["serial"] = _mode_result(sum(latencies), latencies)
+
+    pool = analyze.WorkerPool(processes=processes)
+    try:
+        startup = _timed(lambda: _start(pool))
+        wall = _timed(lambda: analyze.analyze(*sources, mp=True, pool=pool))
+        modes["mp-cold"] = _mode_result(startup + wall)
+        modes["mp-cold"]["startup_s"] = startup
+
+        wall = _timed(lambda: analyze.analyze(*sources, mp=True, pool=pool))
+        modes["mp-warm"] = _mode_result(wall)
+    finally:
+        pool.close()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        parse_cache = analyze.ParseCache(cache.DiskCache(basedir=tmpdir,
+                                                         delta=-1))
+        analyze.analyze(*sources, mp=False, cache=parse_cache)
+        latencies = _serial(cache=parse_cache)
+        modes["cached"] = _mode_result(sum(latencies), latencies)
+
+    return {
+        "target": "analyze",
+        "timestamp": int(time.time()),
+        "names": len(names),
+        "processes": processes,
+        "versions": {
+            "python": platform.python_version(),
+            "guessit": guessit.__version__,
+            "parser": analyze.PARSER_VERSION,
+        },
+        "modes": modes,
+    }
+
+
+def _percentile(values, p):
+    # Nearest-rank percentile over sorted values
+    idx = max(0, min(len(values) - 1, -(-len(values) * p // 100) - 1))
+    return values[idx]
+
 
 def _json_encode_hook(value):
+    if isinstance(value, abc.Mapping):
+        return dict(value)
+
     return str(value)
@@ -18,11 +18,13 @@
 # USA.
 
 
+import html
 import re
 import time
 from datetime import datetime
 from urllib import parse
 
+import bs4
 import humanfriendly
 from arroyo import extensions
 
@@ -31,6 +33,32 @@ class EzTV(extensions.Provider):
     BASE_URI = "https://eztv.io"
     DEFAULT_URI = BASE_URI + "/page_0"
     URI_REGEXPS = [r"^http(s)?://([^.]\.)?eztv\.[^.]{2,3}/"]
+    # Only result rows
+    PARSE_ONLY = bs4.SoupStrainer(
+        "tr", attrs={"name": "hover", "class": "forum_header_border"}
+    )
+
+    SETTINGS_PREFIX = "plugin.provider.eztv"
+    PARSE_MODES = ("stream", "dom")
+
+    # Streaming mode: magnet links and, in one pass over the row text, size
+    # and age (with the same expressions as parse_size and parse_timestamp)
+    _STREAM_MAGNET_RE = re.compile(r"""href=(["'])(magnet:\?.*?)\1""")
+    _STREAM_ROW_INFO_RE = re.compile(
+        r"(?P<size>(?i:\d+(\.\d+)?\s+[TGMK]B))"
+        r"|(?P<short_age>(\d+)([mhd]) (\d+)([smhd]))"
+        r"|(?P<long_age>(\d+) (w|mo|y))"
+    )
+
+    _TIME_MULTS = {
+        "s": 1,
+        "m": 60,
+        "h": 60 * 60,
+        "d": 60 * 60 * 24,
+        "w": 60 * 60 * 24 * 7,
+        "mo": 60 * 60 * 24 * 30,
+        "y": 60 * 60 * 24 * 365,
+    }
 
     def paginate(self, uri):
         parsed = parse.urlparse(uri)
@@ -77,12 +105,84 @@ class EzTV(extensions.Provider):
         return "{base}/search/{q}".format(base=self.BASE_URI, q=parse.quote_plus(q))
 
     def parse(self, buffer):
+        mode = self.srvs.settings.get(self.SETTINGS_PREFIX + ".parse-mode",
+                                      "stream")
+        if mode not in self.PARSE_MODES:
+            raise ValueError(mode)
+
+        if mode == "stream":
+            items = self.parse_stream(buffer)
+            # Markup may have changed, the DOM parser is more forgiving
+            if items:
+                return items
+
         soup = self.parse_as_soup(buffer)
         rows = self.parse_page(soup)
         items = [self.parse_row(row) for row in rows]
 
         return items
 
+    def parse_stream(self, buffer):
+        """
+        Parse buffer without building a DOM.
+
+        Rows are located from their magnet links in the raw buffer (the
+        enclosing '<tr' and '</tr>'). Size and age are taken from the same
+        row text in a single scan. Returns the same items as parse_row().
+        """
+        items = []
+        prev_start = None
+
+        for m in self._STREAM_MAGNET_RE.finditer(buffer):
+            start = buffer.rfind("<tr", 0, m.start())
+            end = buffer.find("</tr>", m.end())
+            if start == -1 or end == -1 or start == prev_start:
+                continue
+
+            prev_start = start
+            items.append(self.parse_stream_row(
+                buffer[start:end], html.unescape(m.group(2))))
+
+        return items
+
+    def parse_stream_row(self, text, magnet):
+        name = parse.parse_qs(parse.urlparse(magnet).query)["dn"][0]
+
+        size = None
+        short_age = None
+        long_age = None
+        for m in self._STREAM_ROW_INFO_RE.finditer(text):
+            if m.group("size") and size is None:
+                size = m.group("size")
+            elif m.group("short_age") and short_age is None:
+                short_age = m.group(4, 5, 6, 7)
+            elif m.group("long_age") and long_age is None:
+                long_age = m.group(9, 10)
+
+            if size is not None and short_age is not None:
+                break
+
+        try:
+            size = self._convert_size(size)
+        except ValueError:
+            size = None
+
+        if short_age:
+            timestamp = self._convert_age(*short_age)
+        elif long_age:
+            timestamp = self._convert_age(*long_age)
+        else:
+            timestamp = None
+
+        return {
+            "name": name,
+            "uri": magnet,
+            "size": size,
+            "timestamp": timestamp,
+            "language": "eng-us",
+            "type": "episode",
+        }
+
     def parse_page(self, soup):
         # Get links with magnets
         magnets = [
@@ -129,46 +229,39 @@ class EzTV(extensions.Provider):
         s = str(node)
 
         m = re.search(r"(\d+(\.\d+)?\s+[TGMK]B)", s, re.IGNORECASE)
-        if not m:
-            raise ValueError("No size value found")
 
-        try:
-            return humanfriendly.parse_size(m.group(0))
-        except humanfriendly.InvalidSize as e:
-            raise ValueError("Invalid size") from e
+        return self._convert_size(m.group(0) if m else None)
 
     def parse_timestamp(cls, node):
-        def _do_diff(diff):
-            return int(time.mktime(datetime.now().timetuple())) - diff
-
-        _table_mults = {
-            "s": 1,
-            "m": 60,
-            "h": 60 * 60,
-            "d": 60 * 60 * 24,
-            "w": 60 * 60 * 24 * 7,
-            "mo": 60 * 60 * 24 * 30,
-            "y": 60 * 60 * 24 * 365,
-        }
-
         s = str(node)
 
         # Search for minutes, hours, days
         m = re.search(r"(\d+)([mhd]) (\d+)([smhd])", s)
         if m:
-            amount1 = int(m.group(1))
-            qual1 = m.group(2)
-            amount2 = int(m.group(3))
-            qual2 = m.group(4)
-            diff = amount1 * _table_mults[qual1] + amount2 * _table_mults[qual2]
-
-            return _do_diff(diff)
+            return cls._convert_age(*m.groups())
 
         # Search for weeks, months, years
         m = re.search(r"(\d+) (w|mo|y)", s)
         if m:
-            diff = int(m.group(1)) * _table_mults[m.group(2)]
-            return _do_diff(diff)
+            return cls._convert_age(*m.groups())
 
         # :shrug:
         raise ValueError("No created value found")
+
+    def _convert_size(self, text):
+        if not text:
+            raise ValueError("No size value found")
+
+        try:
+            return humanfriendly.parse_size(text)
+        except humanfriendly.InvalidSize as e:
+            raise ValueError("Invalid size") from e
+
+    def _convert_age(self, *amounts_and_units):
+        # Pairs of amount and unit, i.e. ('1', 'm', '7', 's') for '1m 7s'
+        diff = 0
+        for idx in range(0, len(amounts_and_units), 2):
+            amount, unit = amounts_and_units[idx:idx+2]
+            diff += int(amount) * self._TIME_MULTS[unit]
+
+        return int(time.mktime(datetime.now().timetuple())) - diff
@@ -25,6 +25,7 @@ from datetime import datetime
 from urllib import parse
 
 
+import bs4
 import humanfriendly
 
 
@@ -56,6 +57,15 @@ class ThePirateBay(extensions.Provider):
         + "/search/{q}/0/99/0"
     )
 
+    MIRRORS = [
+        "{proto}://thepiratebay.{tld}".format(proto=PROTO, tld=TLD),
+        "https://thepiratebay10.org",
+        "https://thepiratebay.zone",
+    ]
+
+    # Only the results table
+    PARSE_ONLY = bs4.SoupStrainer("table", id="searchResult")
+
     _TYPE_TABLE = {
         "applications": {
             "applications": "other",
@@ -46,9 +46,6 @@ import time
 from urllib import parse
 
 
-import aiohttp
-
-
 from arroyo import extensions, schema
 
 
@@ -65,6 +62,9 @@ class TorrentAPI(extensions.Provider):
 
     URI_REGEXPS = [r"^http(s)?://([^.]+.)?torrentapi\.org/pubapi_v2.php\?"]
 
+    # API allows one request every two seconds
+    RATE_LIMIT = {"max-in-flight": 1, "min-interval": 2.0}
+
     CATEGORY_MAP = {
         schema.get_entity_name(schema.Episode): "tv",
         schema.get_entity_name(schema.Movie): "movies",
@@ -76,42 +76,27 @@ class TorrentAPI(extensions.Provider):
         # self.logger = self.app.logger.getChild('torrentapi')
         self.token = None
         self.token_ts = 0
-        self.token_last_use = 0
 
-    async def fetch(self, fetcher, uri):
-        await self.refresh_token()
-        await asyncio.sleep(0.5)
+    async def fetch(self, fetcher, uri, headers=None):
+        await self.refresh_token(fetcher)
         uri = alter_query_params(
             uri, dict(format="json_extended", limit=100, sort="last", token=self.token)
         )
-        return await super().fetch(fetcher, uri)
+        return await super().fetch(fetcher, uri, headers=headers)
 
-    async def refresh_token(self):
+    async def refresh_token(self, sess):
         # Refresh token if it's older than 15M
         if time.time() - self.token_ts >= 15 * 60:
-            conn = aiohttp.TCPConnector(verify_ssl=False)
-            client = aiohttp.ClientSession(connector=conn)
-            resp = await client.get(self.TOKEN_URI)
-            buff = await resp.content.read()
-            await resp.release()
-            await client.close()
+            async with sess.get(self.TOKEN_URI) as resp:
+                buff = await resp.content.read()
 
             # FIXME: Handle json.JSONDecodeError
             self.token = json.loads(buff.decode("utf-8"))["token"]
 
             self.token_ts = time.time()
-            self.token_last_use = None
-            return
-
-        # No need to throttle
-        if self.token_last_use is None:
-            return
-
-        # throttle
-        now = time.time()
-        since_last_use = self.token_last_use - now
-        if since_last_use < 2:
-            await asyncio.sleep(2 - since_last_use)
+
+            # The token request counts against the API rate limit
+            await asyncio.sleep(self.RATE_LIMIT["min-interval"])
 
     def parse(self, buff):
         def convert_data(e):
@@ -18,6 +18,9 @@
 # USA.
 
 
+from collections import abc
+
+
 from arroyo import (
     analyze,
     schema
@@ -173,6 +176,10 @@ class Engine:
         return filters
 
     def apply(self, ctx, collection, mp=True):
+        # Streams (i.e. from analyze.analyze_iter) are filtered as they come
+        if not isinstance(collection, abc.Sequence):
+            return self.apply_iter(ctx, collection)
+
         ret = collection
         for (f, key, value) in ctx:
             prev = len(ret)
@@ -190,6 +197,20 @@ class Engine:
 
         return ret
 
+    def apply_iter(self, ctx, iterable):
+        prev = curr = 0
+
+        for item in iterable:
+            prev += 1
+            if all(f.filter(key, value, item) for (f, key, value) in ctx):
+                curr += 1
+                yield item
+
+        logmsg = "applied filters '%s' over %s items: %s items left"
+        logmsg = logmsg % (','.join([key for (f, key, value) in ctx]),
+                           prev, curr)
+        self.srvs.logger.debug(logmsg)
+
     def sort(self, collection):
         groups = {}
 
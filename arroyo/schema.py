@@ -23,6 +23,7 @@ import binascii
 import hashlib
 import re
 import typing
+from collections import abc
 from urllib import parse
 
 import pydantic
@@ -138,8 +139,28 @@ class Movie(pydantic.BaseModel):
         return f"<Movie id={self.id}>"
 
 
+class Metadata(abc.Mapping):
+    """
+    Base class for read-only metadata mappings (see analyze.LazyMetadata).
+    Instances are stored as-is in Source.metadata instead of being copied
+    into a dict by pydantic.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if not isinstance(value, cls):
+            raise TypeError(value)
+
+        return value
+
+
 EntityType = typing.Union[Episode, Movie]
-MetadataType = typing.Dict[str, typing.Any]
+MetadataType = typing.Union[Metadata, typing.Dict[str, typing.Any]]
 
 
 class Source(pydantic.BaseModel):
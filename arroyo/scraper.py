@@ -19,17 +19,57 @@
 
 
 import asyncio
+import collections
+import contextlib
+import email.utils
+import itertools
+import math
+import random
+import time
+import weakref
+from concurrent import futures
+from urllib import parse
 
 
 import aiohttp
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 
 from arroyo import (
     defaults,
     extensions,
     schema
 )
-from arroyo.services import cache
+from arroyo.services import (
+    Services,
+    cache,
+    loader,
+    settings,
+    storage
+)
+
+
+def _brotli_decodes(module):
+    # aiohttp decodes br with brotlipy's API (Decompressor.decompress), the
+    # 'Brotli' package installs a module with the same name and a different
+    # API (Decompressor.process), and fails on every br response
+    decompressor = getattr(module, 'Decompressor', None)
+    return callable(getattr(decompressor, 'decompress', None))
+
+
+# Content codings decoded by aiohttp, brotli only if a module it can use is
+# installed
+ACCEPT_ENCODING = ('gzip, deflate, br' if _brotli_decodes(brotli)
+                   else 'gzip, deflate')
+
+# Requests per host used to compute latency percentiles for hedging and how
+# many are needed to do it
+LATENCY_WINDOW = 100
+HEDGE_MIN_SAMPLES = 20
 
 
 class Context:
@@ -61,16 +101,442 @@ class Context:
             hexid=hex(id(self)))
 
 
+class HostLimiter:
+    """
+    Limits requests to a single host:
+
+      - max_in_flight: max concurrent requests (None for no limit)
+      - rate / burst: token bucket, rate requests per second with bursts of
+        up to burst requests (None rate for no limit)
+      - min_interval: min seconds between the start of two requests
+    """
+    def __init__(self, max_in_flight=None, rate=None, burst=1,
+                 min_interval=0.0):
+        self.max_in_flight = max_in_flight
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_interval = min_interval
+
+        self._in_flight = (asyncio.Semaphore(max_in_flight)
+                           if max_in_flight else None)
+        self._pacing = asyncio.Lock()
+        self._tokens = float(self.burst)
+        self._updated = None
+        self._last = None
+
+    async def __aenter__(self):
+        if self._in_flight:
+            await self._in_flight.acquire()
+
+        try:
+            await self.wait_turn()
+        except BaseException:
+            if self._in_flight:
+                self._in_flight.release()
+            raise
+
+    async def __aexit__(self, *exc_info):
+        if self._in_flight:
+            self._in_flight.release()
+
+    async def wait_turn(self):
+        async with self._pacing:
+            while True:
+                now = time.monotonic()
+                delay = self._delay(now)
+                if delay <= 0:
+                    break
+
+                await asyncio.sleep(delay)
+
+            if self.rate:
+                self._tokens -= 1
+            self._last = now
+
+    def _delay(self, now):
+        delay = 0.0
+
+        if self.min_interval and self._last is not None:
+            delay = self._last + self.min_interval - now
+
+        if self.rate:
+            if self._updated is not None:
+                elapsed = now - self._updated
+                self._tokens = min(self.burst,
+                                   self._tokens + elapsed * self.rate)
+            self._updated = now
+
+            if self._tokens < 1:
+                delay = max(delay, (1 - self._tokens) / self.rate)
+
+        return delay
+
+
+class RateLimiter:
+    """
+    Request slots for a fetch run: a HostLimiter per host, built from the
+    provider's RATE_LIMIT, plus a global cap on requests in flight.
+
+    Host limits are waited for before taking a global slot so strict or slow
+    hosts don't hold slots other providers could use.
+    """
+    def __init__(self, max_in_flight, max_in_flight_per_host=None):
+        self.max_in_flight_per_host = max_in_flight_per_host
+        self._global = asyncio.Semaphore(max_in_flight)
+        self._hosts = {}
+
+    def host_limiter(self, ctx):
+        host = parse.urlparse(ctx.uri).netloc
+
+        try:
+            return self._hosts[host]
+        except KeyError:
+            pass
+
+        params = {'max-in-flight': self.max_in_flight_per_host}
+        params.update(ctx.provider.RATE_LIMIT)
+        params = {k.replace('-', '_'): v for (k, v) in params.items()}
+
+        self._hosts[host] = HostLimiter(**params)
+        return self._hosts[host]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, ctx):
+        async with self.host_limiter(ctx):
+            async with self._global:
+                yield
+
+
+class RetryPolicy:
+    """
+    How failed requests are retried:
+
+      - attempts: max number of requests (1 for no retries)
+      - backoff / max_backoff: delay before the second attempt, doubled for
+        each following one up to max_backoff. HTTP 429 responses with a
+        Retry-After header are retried after the delay it asks for, or not
+        at all if it is longer than max_backoff
+      - jitter: random fraction (0 to 1) subtracted from delays so retries
+        from concurrent requests don't align
+      - retry_on: retryable errors, any of 'timeout', 'connection' and
+        'server-error' (HTTP 5xx and 429 responses). Timeouts aren't
+        retried by default, each one already takes the whole timeout
+      - hedge: send a second request if the first one is slower than the
+        host's p95 latency (see Engine.latency_percentile)
+    """
+    ERRORS = ('timeout', 'connection', 'server-error')
+    DEFAULT_RETRY_ON = ('connection', 'server-error')
+
+    def __init__(self, attempts=1, backoff=0.5, max_backoff=10.0, jitter=0.5,
+                 retry_on=DEFAULT_RETRY_ON, hedge=False):
+        unknown = set(retry_on) - set(self.ERRORS)
+        if unknown:
+            raise ValueError("Unknown retryable errors: %s" %
+                             ', '.join(sorted(unknown)))
+
+        self.attempts = max(1, int(attempts))
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_on = tuple(retry_on)
+        self.hedge = hedge
+
+    def delay(self, attempt):
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    @staticmethod
+    def is_server_error(status):
+        return status >= 500 or status == 429
+
+
+class MirrorSelector:
+    """
+    Ranks the mirrors of providers (see Provider.MIRRORS) by their scores:
+    moving averages (EWMA) of request latency and error rate.
+
+    Mirrors without score go first (in MIRRORS order) so each one gets
+    probed, then healthy ones, fastest first, and then unhealthy ones.
+    Unhealthy mirrors without requests for RECHECK_AFTER seconds are
+    ranked right after the healthy ones, so they are probed again when
+    those fail.
+
+    Scores are loaded from the database on first use and saved with
+    save(), so they are kept between runs.
+    """
+    ALPHA = 0.3
+    UNHEALTHY_ERRORS = 0.5
+    RECHECK_AFTER = 60 * 60
+
+    def __init__(self, db):
+        self.db = db
+        self._scores = None
+        self._dirty = set()
+
+    @property
+    def scores(self):
+        if self._scores is None:
+            self._scores = self.db.get_mirror_scores()
+
+        return self._scores
+
+    def rank(self, provider, uri):
+        """
+        uri on each of the provider's mirrors, best first. Just [uri] if
+        it's not on one of them.
+        """
+        mirrors = [_uri_base(x) for x in provider.MIRRORS]
+        if _uri_base(uri) not in mirrors:
+            return [uri]
+
+        now = time.time()
+
+        def _key(idx):
+            score = self.scores.get(mirrors[idx])
+            if score is None:
+                return (0, 0, idx)
+
+            if score['errors'] >= self.UNHEALTHY_ERRORS:
+                # Not probed first, a run after a long pause would wait for
+                # its timeout on a dead mirror, just the first fallback
+                if now - score['updated'] > self.RECHECK_AFTER:
+                    return (2, 0, idx)
+
+                return (3, score['errors'], idx)
+
+            if score['latency'] is None:
+                return (0, 0, idx)
+
+            return (1, score['latency'], idx)
+
+        order = sorted(range(len(mirrors)), key=_key)
+        return [_with_base(uri, mirrors[idx]) for idx in order]
+
+    def record(self, provider, uri, latency, error=False):
+        base = _uri_base(uri)
+        if base not in [_uri_base(x) for x in provider.MIRRORS]:
+            return
+
+        # Averages start at the first sample
+        score = self.scores.setdefault(base, {
+            'latency': None,
+            'errors': None,
+            'updated': 0
+        })
+
+        if not error:
+            score['latency'] = self._ewma(score['latency'], latency)
+        score['errors'] = self._ewma(score['errors'], 1.0 if error else 0.0)
+        score['updated'] = time.time()
+
+        self._dirty.add(base)
+
+    def save(self):
+        for base in self._dirty:
+            self.db.set_mirror_score(base, **self.scores[base])
+
+        self._dirty = set()
+
+    def _ewma(self, prev, value):
+        if prev is None:
+            return value
+
+        return self.ALPHA * value + (1 - self.ALPHA) * prev
+
+
+class CircuitBreaker:
+    """
+    Keeps providers known to be down out of queries.
+
+    A provider's circuit opens after `failures` consecutive failed requests
+    (connection errors, timeouts or server errors once retries are
+    exhausted) and stays open for `cooldown` seconds. Then it's half-open:
+    one request is let through as a probe, if it succeeds the circuit is
+    closed, otherwise it's opened again.
+
+    Circuits are saved to the database on each change, so they are kept
+    between runs.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, db, failures=3, cooldown=600):
+        self.db = db
+        self.failures = failures
+        self.cooldown = cooldown
+        self._circuits = None
+
+    @property
+    def circuits(self):
+        if self._circuits is None:
+            self._circuits = self.db.get_circuits()
+
+        return self._circuits
+
+    def state(self, name):
+        circuit = self.circuits.get(name)
+        if circuit is None or circuit['opened'] is None:
+            return self.CLOSED
+
+        if time.time() - circuit['opened'] < self.cooldown:
+            return self.OPEN
+
+        return self.HALF_OPEN
+
+    def allow(self, name):
+        """
+        Whether requests to provider name can be made. On half-open
+        circuits the first call is the probe, following ones get False
+        until its outcome is recorded (or cooldown expires).
+        """
+        state = self.state(name)
+        if state == self.CLOSED:
+            return True
+
+        if state == self.OPEN:
+            return False
+
+        circuit = self.circuits[name]
+        now = time.time()
+        if circuit['probing'] and now - circuit['probing'] < self.cooldown:
+            return False
+
+        circuit['probing'] = now
+        self._save(name)
+
+        return True
+
+    def record(self, name, ok):
+        circuit = self.circuits.get(name)
+
+        if ok:
+            if circuit is None or (circuit['failures'] == 0 and
+                                   circuit['opened'] is None):
+                return
+
+            circuit.update(failures=0, opened=None, probing=None)
+
+        else:
+            circuit = self.circuits.setdefault(name, {
+                'failures': 0,
+                'opened': None,
+                'probing': None
+            })
+            circuit['failures'] += 1
+
+            # A failed probe opens the circuit again
+            if circuit['probing'] or circuit['failures'] >= self.failures:
+                circuit.update(opened=time.time(), probing=None)
+
+        self._save(name)
+
+    def release(self, name):
+        """
+        Ends a probe (see allow()) without recording an outcome.
+        """
+        circuit = self.circuits.get(name)
+        if circuit is None or not circuit['probing']:
+            return
+
+        circuit['probing'] = None
+        self._save(name)
+
+    def _save(self, name):
+        self.db.set_circuit(name, **self.circuits[name])
+
+
+class SessionManager:
+    """
+    Long-lived event loop and aiohttp sessions for scraper runs.
+
+    Sessions use a pooled connector so connections (and DNS lookups, TLS
+    handshakes) are reused between runs. There is one session per event
+    loop: the manager's own loop (used by the sync API, see run()) and any
+    loop the async API is called from.
+
+    close() releases the own loop and its session, sessions of other loops
+    must be released from them with aclose().
+    """
+    def __init__(self, session_options=None, connector_options=None):
+        self.session_options = session_options or {}
+        self.connector_options = connector_options or {}
+        self._loop = None
+        self._sessions = weakref.WeakKeyDictionary()
+
+    @property
+    def loop(self):
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+
+        return self._loop
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    async def session(self):
+        loop = asyncio.get_running_loop()
+        sess = self._sessions.get(loop)
+
+        if sess is None or sess.closed:
+            # Both need a running loop
+            connector = aiohttp.TCPConnector(**self.connector_options)
+            sess = aiohttp.ClientSession(
+                connector=connector, cookie_jar=aiohttp.CookieJar(),
+                **self.session_options)
+            self._sessions[loop] = sess
+
+        return sess
+
+    async def aclose(self):
+        sess = self._sessions.pop(asyncio.get_running_loop(), None)
+        if sess is not None and not sess.closed:
+            await sess.close()
+
+    def close(self):
+        if self._loop is None:
+            return
+
+        self.run(self.aclose())
+        self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+        self._loop.close()
+
+        self._loop = None
+
+
 class Engine:
+    PARSE_EXECUTORS = ('serial', 'threads', 'processes')
+
     def __init__(self, srvs, logger=None):
         self.srvs = srvs
         self.logger = logger or self.srvs.logger.getChild('scraper.Engine')
+        self._executor = None
+        self._executor_type = None
+        self._sessions = None
+        self._limiters = weakref.WeakKeyDictionary()
+        self._mirrors = None
+        self._circuits = None
+        self._in_flight = weakref.WeakKeyDictionary()
+        self._latencies = collections.defaultdict(
+            lambda: collections.deque(maxlen=LATENCY_WINDOW))
+
+        # Fetch counters: 'requests' made to _fetch_one(), how many of them
+        # were 'coalesced' into an in-flight fetch of the same URI, 'retries'
+        # and 'hedged' requests
+        self.stats = collections.Counter()
 
     def setting(self, key):
         ret = self.srvs.settings.get(key)
 
         if key in (defaults.KEY_SCRAPER_TIMEOUT,
-                   defaults.KEY_SCRAPER_MAX_PARALEL_REQUESTS):
+                   defaults.KEY_SCRAPER_MAX_PARALEL_REQUESTS,
+                   defaults.KEY_SCRAPER_MAX_PARALEL_REQUESTS_PER_HOST,
+                   defaults.KEY_SCRAPER_CONNECTIONS_PER_HOST,
+                   defaults.KEY_SCRAPER_KEEPALIVE_TIMEOUT,
+                   defaults.KEY_SCRAPER_DNS_CACHE_TTL,
+                   defaults.KEY_SCRAPER_RETRY_ATTEMPTS,
+                   defaults.KEY_SCRAPER_CIRCUIT_FAILURES,
+                   defaults.KEY_SCRAPER_CIRCUIT_COOLDOWN):
             try:
                 ret = int(ret)
             except ValueError:
@@ -80,118 +546,618 @@ class Engine:
 
                 return defaults.SETTINGS[key]
 
+        elif key == defaults.KEY_SCRAPER_HEDGE:
+            if not isinstance(ret, bool):
+                ret = str(ret).lower() in ('1', 'true', 'yes', 'on')
+
         else:
             ret = str(ret)
 
         return ret
 
     def process(self, *ctxs):
-        ctxs_and_buffers = self.fetch(*ctxs)
-        results = self.parse(*ctxs_and_buffers)
+        return self.sessions.run(self.aprocess(*ctxs))
+
+    async def aprocess(self, *ctxs):
+        """
+        Fetch and parse contexts.
+
+        Each buffer is handed to a parse worker as soon as it's fetched, so
+        parsing overlaps with pending requests. Sources are returned in
+        completion order.
+        """
+        async def _task(ctx, sess, limiter):
+            entry = await self._fetch_one(ctx, sess, limiter)
+            if entry is None:
+                return []
 
-        return results
+            buffer = (_entry_body(entry) if ctx.provider.PARSE_BYTES
+                      else _decode_entry(ctx, entry))
+            return await self._parse_one_async(ctx, buffer)
+
+        ret = []
+        sess = await self.sessions.session()
+        limiter = self.rate_limiter
+
+        tasks = [_task(ctx, sess, limiter) for ctx in ctxs]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                ret.extend(await fut)
+        finally:
+            self.mirrors.save()
+
+        return ret
 
     def fetch(self, *ctxs):
-        async def _task(acc, ctx, sess, sem):
+        return self.sessions.run(self.afetch(*ctxs))
+
+    async def afetch(self, *ctxs):
+        async def _task(acc, ctx, sess, limiter):
+            entry = await self._fetch_one(ctx, sess, limiter)
+            if entry is not None:
+                acc.append((ctx, _decode_entry(ctx, entry)))
+
+        ret = []
+        sess = await self.sessions.session()
+        limiter = self.rate_limiter
+
+        tasks = [_task(ret, ctx, sess, limiter) for ctx in ctxs]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.mirrors.save()
+
+        return ret
+
+    def process_incremental(self, ctx, max_pages):
+        return self.sessions.run(self.aprocess_incremental(ctx, max_pages))
+
+    async def aprocess_incremental(self, ctx, max_pages):
+        """
+        Fetch and parse up to max_pages pages of ctx (see
+        Provider.paginate), one at a time, stopping as soon as a page has
+        nothing new.
+
+        Feeds are assumed to be sorted newest first. The newest source seen
+        is stored as the feed watermark in the database: sources older than
+        it (or the watermark itself) are already seen. Pages made only of
+        seen sources and pages including the watermark (next pages are older)
+        end the run. Runs stopped by max_pages before reaching the watermark
+        keep it, so sources between them are scraped by later runs.
+        """
+        feed = _feed_key(ctx)
+        watermark = self.srvs.db.get_watermark(feed)
+
+        ret = []
+        capped = False
+        # One more page than max_pages to tell if there are more
+        pages = itertools.islice(ctx.provider.paginate(ctx.uri),
+                                 max_pages + 1)
+        for (n, uri) in enumerate(pages):
+            if n == max_pages:
+                capped = True
+                break
+
+            page_ctx = Context(ctx.provider, uri, type=ctx.type,
+                               language=ctx.language)
+            sources = await self.aprocess(page_ctx)
+            ret.extend(sources)
+
+            if not sources:
+                break
+
+            if watermark and _reaches_watermark(sources, watermark):
+                logmsg = "Feed '%s' has no new sources after page %s"
+                logmsg = logmsg % (feed, n + 1)
+                self.logger.debug(logmsg)
+                break
+
+        if capped and watermark:
+            logmsg = ("Feed '%s' has more new sources than %s pages, "
+                      "watermark kept")
+            logmsg = logmsg % (feed, max_pages)
+            self.logger.warning(logmsg)
+            return ret
+
+        newest = _newest_source(ret)
+        if newest and (not watermark or
+                       not _reaches_watermark([newest], watermark)):
+            self.srvs.db.set_watermark(feed, newest.id, newest.created)
+
+        return ret
+
+    @property
+    def mirrors(self):
+        if self._mirrors is None:
+            self._mirrors = MirrorSelector(self.srvs.db)
+
+        return self._mirrors
+
+    @property
+    def circuits(self):
+        if self._circuits is None:
+            self._circuits = CircuitBreaker(
+                self.srvs.db,
+                failures=self.setting(defaults.KEY_SCRAPER_CIRCUIT_FAILURES),
+                cooldown=self.setting(defaults.KEY_SCRAPER_CIRCUIT_COOLDOWN))
+
+        return self._circuits
+
+    @property
+    def sessions(self):
+        """
+        SessionManager shared by all fetches, built from 'fetch.*' settings
+        on first use. close() releases it.
+        """
+        if self._sessions is None:
+            self._sessions = SessionManager(
+                session_options=self._session_options(),
+                connector_options=self._connector_options())
+
+        return self._sessions
+
+    @property
+    def rate_limiter(self):
+        # One per event loop (asyncio primitives are bound to it), living as
+        # long as the loop so host limits hold between runs
+        loop = asyncio.get_running_loop()
+        if loop not in self._limiters:
+            self._limiters[loop] = RateLimiter(
+                self.setting(defaults.KEY_SCRAPER_MAX_PARALEL_REQUESTS),
+                self.setting(
+                    defaults.KEY_SCRAPER_MAX_PARALEL_REQUESTS_PER_HOST))
+
+        return self._limiters[loop]
+
+    def _connector_options(self):
+        return {
+            'limit': self.setting(defaults.KEY_SCRAPER_MAX_PARALEL_REQUESTS),
+            'limit_per_host': self.setting(
+                defaults.KEY_SCRAPER_CONNECTIONS_PER_HOST),
+            'keepalive_timeout': self.setting(
+                defaults.KEY_SCRAPER_KEEPALIVE_TIMEOUT),
+            'ttl_dns_cache': self.setting(defaults.KEY_SCRAPER_DNS_CACHE_TTL),
+        }
+
+    def _session_options(self):
+        ua = self.setting(defaults.KEY_SCRAPER_UA)
+        timeout = self.setting(defaults.KEY_SCRAPER_TIMEOUT)
+
+        return {
+            'headers': {
+                'User-Agent': ua,
+                'Accept-Encoding': ACCEPT_ENCODING
+            },
+            'timeout': aiohttp.ClientTimeout(total=timeout)
+        }
+
+    async def _fetch_one(self, ctx, sess, limiter):
+        # Single-flight: concurrent requests for the same provider and
+        # normalized URI share one fetch (and one cache write).
+        # Fetches are shielded so a cancelled requester doesn't cancel them
+        # for the others.
+        loop = asyncio.get_running_loop()
+        in_flight = self._in_flight.setdefault(loop, {})
+        key = (_class_path(type(ctx.provider)), normalize_uri(ctx.uri))
+
+        self.stats['requests'] += 1
+
+        try:
+            task = in_flight[key]
+        except KeyError:
+            task = loop.create_task(self._fetch_one_uncoalesced(
+                ctx, sess, limiter))
+            in_flight[key] = task
+            task.add_done_callback(lambda _: in_flight.pop(key, None))
+
+        else:
+            self.stats['coalesced'] += 1
+
+            logmsg = "URI '%s' already being fetched, waiting for it"
+            logmsg = logmsg % ctx.uri
+            self.logger.debug(logmsg)
+
+        try:
+            return await asyncio.shield(task)
+        finally:
+            # Fetches served from cache (or an errored one) tell nothing
+            # about the provider, a half-open circuit is released for
+            # another probe
+            self.circuits.release(ctx.provider_name)
+
+    async def _fetch_one_uncoalesced(self, ctx, sess, limiter):
+        # Returns the fetched (or cached) entry, None on errors.
+        # Entries hold the raw body (bytes, decoded by the consumer, see
+        # Provider.decode) and its charset from the response headers.
+        # Response validators (ETag, Last-Modified) are kept too, so expired
+        # entries can be revalidated with a conditional request instead of
+        # being downloaded again.
+        stale = None
+        try:
+            entry = _cache_entry(self.srvs.cache.get(ctx.uri))
+        except cache.CacheKeyExpiredError:
+            entry = None
             try:
-                content = self.srvs.cache.get(ctx.uri)
+                stale = _cache_entry(self.srvs.cache.get_stale(ctx.uri))
             except cache.CacheKeyError:
-                content = None
+                pass
+        except cache.CacheKeyError:
+            entry = None
 
-            if content:
-                logmsg = "URI '%s' found in cache, %s bytes"
-                logmsg = logmsg % (ctx.uri, len(content))
-                self.logger.debug(logmsg)
-                acc.append((ctx, content))
-                return
+        if entry and entry['body']:
+            logmsg = "URI '%s' found in cache, %s bytes"
+            logmsg = logmsg % (ctx.uri, len(entry['body']))
+            self.logger.debug(logmsg)
+            return entry
 
-            async with sem:
-                try:
-                    logmsg = "Requesting '%s'..."
-                    logmsg = logmsg % ctx.uri
-                    self.logger.debug(logmsg)
-                    content = await ctx.provider.fetch(sess, ctx.uri)
-                except asyncio.TimeoutError:
-                    logmsg = "Timeout for '%s'"
-                    logmsg = logmsg % ctx.uri
-                    self.logger.error(logmsg)
-                    return
-                except aiohttp.ClientConnectionError as e:
-                    logmsg = "Client error for '%s': %s'"
-                    logmsg = logmsg % (ctx.uri, e)
+        # Providers with the old fetch(sess, uri) signature only get
+        # headers when there is something to revalidate
+        headers = _conditional_headers(stale) if stale else {}
+
+        resp = await self._request_with_retries(ctx, sess, limiter, headers)
+        self.circuits.record(
+            ctx.provider_name,
+            resp is not None and not RetryPolicy.is_server_error(resp.status))
+
+        if resp is None:
+            return None
+
+        if resp.status == 304 and stale:
+            logmsg = "URI '%s' not modified, reusing cached %s bytes"
+            logmsg = logmsg % (ctx.uri, len(stale['body']))
+            self.logger.debug(logmsg)
+
+            # Refresh entry's timestamp
+            self.srvs.cache.set(ctx.uri, stale)
+            return stale
+
+        entry = _response_entry(resp)
+
+        logmsg = "URI '%s' fetched, %s bytes"
+        logmsg = logmsg % (ctx.uri, len(entry['body']))
+        self.logger.debug(logmsg)
+
+        # Server errors (after retries) still have a body to parse but
+        # aren't cached, they would be served instead of asking again
+        if entry['body'] and not RetryPolicy.is_server_error(resp.status):
+            cached = self._compress_entry(entry)
+
+            logmsg = "URI '%s' saved to cache, %s bytes (%s stored)"
+            logmsg = logmsg % (ctx.uri, len(entry['body']),
+                               len(cached['body']))
+            self.logger.debug(logmsg)
+
+            self.srvs.cache.set(ctx.uri, cached)
+
+        return entry
+
+    def retry_policy(self, ctx):
+        """
+        RetryPolicy for ctx's provider: 'fetch.retry-attempts' and
+        'fetch.hedge' settings updated with the provider's RETRY.
+        """
+        params = {
+            'attempts': self.setting(defaults.KEY_SCRAPER_RETRY_ATTEMPTS),
+            'hedge': self.setting(defaults.KEY_SCRAPER_HEDGE)
+        }
+        params.update(ctx.provider.RETRY)
+        params = {k.replace('-', '_'): v for (k, v) in params.items()}
+
+        return RetryPolicy(**params)
+
+    def latency_percentile(self, ctx, percentile):
+        """
+        Percentile of the latencies of the last requests to ctx's host, None
+        if there are not enough of them.
+        """
+        latencies = self._latencies.get(parse.urlparse(ctx.uri).netloc)
+        if not latencies or len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+
+        latencies = sorted(latencies)
+        idx = math.ceil(percentile / 100 * len(latencies)) - 1
+        return latencies[max(0, idx)]
+
+    async def _request_with_retries(self, ctx, sess, limiter, headers):
+        # Returns the response, None on errors. Failed requests are retried
+        # as configured by the provider's retry policy, waiting the policy
+        # delay between attempts.
+        # Providers with mirrors fail over to the next best mirror (see
+        # MirrorSelector) without waiting.
+        policy = self.retry_policy(ctx)
+        uris = self.mirrors.rank(ctx.provider, ctx.uri)
+        tried = set()
+
+        for attempt in range(1, policy.attempts + 1):
+            retry_after = None
+            untried = [x for x in uris if x not in tried]
+            uri = untried[0] if untried else uris[0]
+            tried.add(uri)
+
+            req_ctx = ctx
+            if uri != ctx.uri:
+                req_ctx = Context(ctx.provider, uri, type=ctx.type,
+                                  language=ctx.language)
+
+            try:
+                resp = await self._hedged_request(req_ctx, sess, limiter,
+                                                  headers, policy)
+            except asyncio.TimeoutError:
+                error = 'timeout'
+                logmsg = "Timeout for '%s'"
+                logmsg = logmsg % uri
+            except (aiohttp.ClientConnectionError,
+                    aiohttp.ClientPayloadError) as e:
+                # Payload errors (truncated or undecodable bodies) are
+                # handled like broken connections
+                error = 'connection'
+                logmsg = "Client error for '%s': %s'"
+                logmsg = logmsg % (uri, e)
+            else:
+                if not policy.is_server_error(resp.status):
+                    return resp
+
+                error = 'server-error'
+                logmsg = "Server error for '%s': %s"
+                logmsg = logmsg % (uri, resp.status)
+
+                if resp.status == 429:
+                    retry_after = _retry_after(resp.headers)
+
+            if error not in policy.retry_on or attempt == policy.attempts:
+                self.logger.error(logmsg)
+
+                # Server errors still have a body
+                return resp if error == 'server-error' else None
+
+            self.stats['retries'] += 1
+
+            if len(tried) < len(uris):
+                logmsg += ", failing over to another mirror"
+                self.logger.warning(logmsg)
+                continue
+
+            delay = policy.delay(attempt)
+            if retry_after is not None:
+                if retry_after > policy.max_backoff:
+                    logmsg += ", server asks to retry in %.2fs, giving up"
+                    logmsg = logmsg % retry_after
                     self.logger.error(logmsg)
-                    return
+                    return resp
 
-                logmsg = "URI '%s' fetched, %s bytes"
-                logmsg = logmsg % (ctx.uri, len(content))
-                self.logger.debug(logmsg)
+                delay = retry_after
 
-                if content:
-                    logmsg = "URI '%s' saved to cache, %s bytes"
-                    logmsg = logmsg % (ctx.uri, len(content))
-                    self.logger.debug(logmsg)
+            logmsg += ", retrying in %.2fs (attempt %s of %s)"
+            logmsg = logmsg % (delay, attempt + 1, policy.attempts)
+            self.logger.warning(logmsg)
 
-                    self.srvs.cache.set(ctx.uri, content)
+            await asyncio.sleep(delay)
 
-                acc.append((ctx, content))
+    async def _hedged_request(self, ctx, sess, limiter, headers, policy):
+        # If hedging is enabled and the request takes longer than the host's
+        # p95 latency a second one is sent, the first to succeed wins and the
+        # other one is cancelled
+        threshold = None
+        if policy.hedge:
+            threshold = self.latency_percentile(ctx, 95)
 
-        async def _wrapper(ctxs):
-            ua = self.setting(defaults.KEY_SCRAPER_UA)
-            timeout = self.setting(defaults.KEY_SCRAPER_TIMEOUT)
-            max_p_requests = self.setting(defaults.KEY_SCRAPER_MAX_PARALEL_REQUESTS)
+        if threshold is None:
+            return await self._request(ctx, sess, limiter, headers)
 
-            sess_opts = {
-                'cookie_jar': aiohttp.CookieJar(),
-                'headers': {
-                    'User-Agent': ua
-                },
-                'timeout': aiohttp.ClientTimeout(total=timeout)
-            }
+        pending = {
+            asyncio.ensure_future(self._request(ctx, sess, limiter, headers))
+        }
+        try:
+            done, pending = await asyncio.wait(pending, timeout=threshold)
+            if done:
+                return done.pop().result()
 
-            ret = []
-            sem = asyncio.Semaphore(max_p_requests)
+            self.stats['hedged'] += 1
 
-            async with aiohttp.ClientSession(**sess_opts) as sess:
-                tasks = [_task(ret, ctx, sess, sem) for ctx in ctxs]
-                await asyncio.gather(*tasks)
+            logmsg = ("URI '%s' is taking longer than %.2fs, sending hedged "
+                      "request")
+            logmsg = logmsg % (ctx.uri, threshold)
+            self.logger.debug(logmsg)
 
-            return ret
+            pending.add(asyncio.ensure_future(
+                self._request(ctx, sess, limiter, headers)))
+
+            while True:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+
+                # Both failed
+                if not pending:
+                    return done.pop().result()
+
+        finally:
+            # Also on cancellation: requests must not outlive the caller
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _request(self, ctx, sess, limiter, headers):
+        # Single request (within a limiter slot), records its latency
+        async with limiter.slot(ctx):
+            logmsg = "Requesting '%s'..."
+            logmsg = logmsg % ctx.uri
+            self.logger.debug(logmsg)
+
+            t0 = time.monotonic()
+            try:
+                if headers:
+                    resp = await ctx.provider.fetch(sess, ctx.uri,
+                                                    headers=headers)
+                else:
+                    resp = await ctx.provider.fetch(sess, ctx.uri)
+
+            except (asyncio.TimeoutError, aiohttp.ClientError):
+                self.mirrors.record(ctx.provider, ctx.uri,
+                                    time.monotonic() - t0, error=True)
+                raise
+
+            latency = time.monotonic() - t0
+            host = parse.urlparse(ctx.uri).netloc
+            self._latencies[host].append(latency)
+
+        if not isinstance(resp, extensions.Response):
+            # Providers returning plain text (old fetch() contract)
+            resp = extensions.Response(resp)
 
-        return asyncio.run(_wrapper(ctxs))
+        self.mirrors.record(ctx.provider, ctx.uri, latency,
+                            error=RetryPolicy.is_server_error(resp.status))
+
+        return resp
+
+    def _compress_entry(self, entry):
+        # Bodies are stored compressed, they are decompressed when used (see
+        # _entry_body) so i.e. 304 responses reuse them as they are. The
+        # codec is kept in the entry, fresh bodies may start with anything
+        # (a NUL from a UTF-32BE BOM)
+        codec = self.setting(defaults.KEY_SCRAPER_CACHE_COMPRESSION)
+        if codec == 'none':
+            return entry
+
+        if codec not in cache.CODECS:
+            logmsg = "Unknown cache compression '%s', using '%s'"
+            logmsg = logmsg % (
+                codec,
+                defaults.SETTINGS[defaults.KEY_SCRAPER_CACHE_COMPRESSION])
+            self.logger.error(logmsg)
+            codec = defaults.SETTINGS[defaults.KEY_SCRAPER_CACHE_COMPRESSION]
+
+        return dict(entry, body=cache.compress(entry['body'], codec),
+                    encoding=codec)
 
     def fetch_one(self, ctx):
         ctx, content = self.fetch(ctx)[0]
         return content
 
     def parse(self, *ctxs_and_buffers):
+        return self.sessions.run(self.aparse(*ctxs_and_buffers))
+
+    async def aparse(self, *ctxs_and_buffers):
+        tasks = [self._parse_one_async(ctx, buffer)
+                 for (ctx, buffer) in ctxs_and_buffers]
+
         ret = []
+        for sources in await asyncio.gather(*tasks):
+            ret.extend(sources)
 
-        for (ctx, buffer) in ctxs_and_buffers:
+        return ret
 
-            try:
+    @property
+    def executor(self):
+        """
+        Executor for provider parsers, built from the 'parse.executor'
+        setting:
+
+          - serial: parse in the calling thread (the event loop thread in
+            process())
+          - threads: parse in a thread pool
+          - processes: parse in a process pool. Providers are rebuilt in the
+            workers from their class path, they only get the buffer and
+            send back plain item dicts.
+
+        The executor is reused between calls, close() shuts it down.
+        """
+        executor_type = self.setting(defaults.KEY_PARSE_EXECUTOR)
+        if executor_type not in self.PARSE_EXECUTORS:
+            logmsg = "Unknow parse executor '%s', using '%s'"
+            logmsg = logmsg % (
+                executor_type,
+                defaults.SETTINGS[defaults.KEY_PARSE_EXECUTOR])
+            self.logger.error(logmsg)
+            executor_type = defaults.SETTINGS[defaults.KEY_PARSE_EXECUTOR]
+
+        if executor_type != self._executor_type:
+            self._close_executor()
+            if executor_type == 'threads':
+                self._executor = futures.ThreadPoolExecutor()
+            elif executor_type == 'processes':
+                self._executor = futures.ProcessPoolExecutor(
+                    initializer=_init_parse_worker,
+                    initargs=(self.srvs.settings.data,))
+
+            self._executor_type = executor_type
+
+        return self._executor
+
+    def close(self):
+        self._close_executor()
+
+        if self._sessions is not None:
+            self._sessions.close()
+
+        self._sessions = None
+        self._limiters.clear()
+
+    async def aclose(self):
+        """
+        Release resources used by the async API from the running loop, other
+        resources are released by close().
+        """
+        if self._sessions is not None:
+            await self._sessions.aclose()
+
+        self._limiters.pop(asyncio.get_running_loop(), None)
+
+    def _close_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+
+        self._executor = None
+        self._executor_type = None
+
+    async def _parse_one_async(self, ctx, buffer):
+        executor = self.executor
+
+        try:
+            if executor is None:
                 items = ctx.provider.parse(buffer)
-            except (ValueError, IndexError, AttributeError) as e:
-                # Catch some common exceptions from parsers
-                logmsg = ("Provider '%s' failed to parse %d bytes. "
-                          "Maybe parsing is broken (%s)")
-                logmsg = logmsg % (ctx.provider_name, e)
-                self.logger.error(logmsg)
-                continue
 
-            if not items:
-                logmsg = "Provider '%s' may be broken. Got 0 items from '%s'."
-                logmsg = logmsg % (ctx.provider_name, ctx.uri)
-                self.logger.warning(logmsg)
-                continue
+            elif isinstance(executor, futures.ProcessPoolExecutor):
+                loop = asyncio.get_running_loop()
+                items = await loop.run_in_executor(
+                    executor, _parse_in_worker,
+                    _class_path(ctx.provider.__class__), buffer)
 
-            for item in items:
-                try:
-                    ret.append(self._build_source(ctx, item))
-                except schema.ValidationError:
-                    logmsg = "Got invalid data from provider '%s', skipping."
-                    logmsg = logmsg % ctx.provider_name
-                    self.logger.warning(logmsg)
-                    break
+            else:
+                loop = asyncio.get_running_loop()
+                items = await loop.run_in_executor(
+                    executor, ctx.provider.parse, buffer)
+
+        except (ValueError, IndexError, AttributeError) as e:
+            # Catch some common exceptions from parsers
+            logmsg = ("Provider '%s' failed to parse %d bytes. "
+                      "Maybe parsing is broken (%s)")
+            logmsg = logmsg % (ctx.provider_name, len(buffer), e)
+            self.logger.error(logmsg)
+            return []
+
+        return self._build_sources(ctx, items)
+
+    def _build_sources(self, ctx, items):
+        if not items:
+            logmsg = "Provider '%s' may be broken. Got 0 items from '%s'."
+            logmsg = logmsg % (ctx.provider_name, ctx.uri)
+            self.logger.warning(logmsg)
+            return []
+
+        ret = []
+        for item in items:
+            try:
+                ret.append(self._build_source(ctx, item))
+            except schema.ValidationError:
+                logmsg = "Got invalid data from provider '%s', skipping."
+                logmsg = logmsg % ctx.provider_name
+                self.logger.warning(logmsg)
+                break
 
         return ret
 
@@ -256,7 +1222,12 @@ class Engine:
         ctx0 = self.build_context(*args, **kwargs)
         return list(_expand(ctx0, n))
 
-    def build_contexts_for_query(self, q):
+    def build_contexts_for_query(self, q, skipped=None):
+        """
+        Contexts for q from all providers. Providers known to be down (see
+        CircuitBreaker) are skipped, their names are appended to skipped if
+        it's a list.
+        """
         def _get_url(provider):
             try:
                 url = provider.get_query_uri(q)
@@ -279,11 +1250,198 @@ class Engine:
         prov_and_uris = [(x, _get_url(x)) for x in providers]
         prov_and_uris = [(p, u) for (p, u) in prov_and_uris if u]
 
+        def _allowed(provider):
+            name = provider.__class__.__name__.lower()
+            if self.circuits.allow(name):
+                return True
+
+            logmsg = "Provider '%s' is known to be down, skipping it"
+            logmsg = logmsg % name
+            self.logger.info(logmsg)
+
+            if skipped is not None:
+                skipped.append(name)
+
+            return False
+
+        # Providers known to be down would only make the query wait for
+        # their timeout
+        prov_and_uris = [(p, u) for (p, u) in prov_and_uris if _allowed(p)]
+
         ctxs = [self.build_context(provider=p, uri=u)
                 for(p, u) in prov_and_uris]
 
         return ctxs
 
 
+def normalize_uri(uri):
+    """
+    Normalize uri for comparisons: lowercase scheme and host, no default
+    port, no fragment and sorted query parameters.
+    """
+    parsed = parse.urlsplit(uri)
+
+    scheme = parsed.scheme.lower()
+    netloc = (parsed.hostname or '').lower()
+    default_port = {'http': 80, 'https': 443}.get(scheme)
+    if parsed.port and parsed.port != default_port:
+        netloc = '%s:%s' % (netloc, parsed.port)
+    if parsed.username or parsed.password:
+        userinfo = parsed.username or ''
+        if parsed.password:
+            userinfo += ':' + parsed.password
+        netloc = userinfo + '@' + netloc
+
+    query = parse.urlencode(sorted(parse.parse_qsl(
+        parsed.query, keep_blank_values=True)))
+
+    return parse.urlunsplit((scheme, netloc, parsed.path or '/', query, ''))
+
+
+def _uri_base(uri):
+    parsed = parse.urlsplit(uri)
+    return '%s://%s' % (parsed.scheme.lower(), parsed.netloc.lower())
+
+
+def _with_base(uri, base):
+    parsed = parse.urlsplit(uri)
+    base = parse.urlsplit(base)
+    return parse.urlunsplit(parsed._replace(scheme=base.scheme,
+                                            netloc=base.netloc))
+
+
+def _feed_key(ctx):
+    return '%s:%s' % (ctx.provider_name, normalize_uri(ctx.uri))
+
+
+def _is_seen(source, watermark):
+    if source.id == watermark['source_id']:
+        return True
+
+    return (source.created is not None and
+            watermark['created'] is not None and
+            source.created <= watermark['created'])
+
+
+def _reaches_watermark(sources, watermark):
+    return (all(_is_seen(x, watermark) for x in sources) or
+            any(x.id == watermark['source_id'] for x in sources))
+
+
+def _newest_source(sources):
+    # Sources without timestamp only count if there isn't any other, feed
+    # order (newest first) is used then
+    dated = [x for x in sources if x.created is not None]
+    if dated:
+        return max(dated, key=lambda x: x.created)
+
+    return sources[0] if sources else None
+
+
+def _cache_entry(value):
+    # Entries from older versions hold only the (decoded) body or hold it
+    # without charset
+    if isinstance(value, str):
+        value = {'body': value, 'etag': None, 'last-modified': None}
+
+    if isinstance(value['body'], str):
+        value = dict(value, body=value['body'].encode('utf-8'),
+                     charset='utf-8')
+
+    return value
+
+
+def _response_entry(resp):
+    body = resp.body or b''
+    charset = resp.charset
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+        charset = 'utf-8'
+
+    return {
+        'body': body,
+        'charset': charset,
+        'etag': resp.etag,
+        'last-modified': resp.last_modified
+    }
+
+
+def _entry_body(entry):
+    if entry.get('encoding') is None:
+        return entry['body']
+
+    return cache.decompress(entry['body'])
+
+
+def _decode_entry(ctx, entry):
+    return ctx.provider.decode(_entry_body(entry), entry['charset'])
+
+
+def _retry_after(headers):
+    # Seconds to wait as asked by a Retry-After header (delay in seconds or
+    # HTTP date), None if missing or invalid
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if date is None or date.tzinfo is None:
+        return None
+
+    return max(0.0, date.timestamp() - time.time())
+
+
+def _conditional_headers(entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last-modified'):
+        headers['If-Modified-Since'] = entry['last-modified']
+
+    return headers
+
+
+def _class_path(cls):
+    return cls.__module__ + '.' + cls.__qualname__
+
+
+# Services and providers for _parse_in_worker, one per class and process
+_worker_srvs = None
+_worker_providers = {}
+
+
+def _init_parse_worker(settings_data):
+    # Workers get a copy of the parent settings (i.e. 'parse.html-parser'),
+    # other services are the default ones.
+    global _worker_srvs
+
+    settings_storage = storage.MemoryStorage()
+    settings_storage.write(settings_data)
+    _worker_srvs = Services(settings=settings.Settings(settings_storage))
+
+
+def _parse_in_worker(provider_path, buffer):
+    # Runs in parse executor processes. Provider instances can't be sent to
+    # them (they hold services like the database) so they are built here
+    # from its class path.
+    try:
+        provider = _worker_providers[provider_path]
+    except KeyError:
+        cls = loader.ClassLoader().resolve(provider_path)
+        provider = cls(_worker_srvs or Services())
+        _worker_providers[provider_path] = provider
+
+    return provider.parse(buffer)
+
+
 class ProviderMissingError(Exception):
     pass
@@ -27,12 +27,45 @@ import shutil
 import sys
 import tempfile
 import time
+import zlib
 
 
 def _now():
     return time.time()
 
 
+# Codecs for compress(): name -> (compress, decompress)
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+
+
+def compress(data, codec='zlib'):
+    """
+    Compress bytes with codec, prefixing them with a header naming it:
+    NUL, codec name, NUL.
+    """
+    compressfn, dummy = CODECS[codec]
+    return b'\0' + codec.encode('ascii') + b'\0' + compressfn(data)
+
+
+def decompress(blob):
+    """
+    Decompress data from compress(). Data without header (not compressed)
+    is returned as is.
+    """
+    if not blob.startswith(b'\0'):
+        return blob
+
+    codec, data = blob[1:].split(b'\0', 1)
+    try:
+        dummy, decompressfn = CODECS[codec.decode('ascii')]
+    except KeyError as e:
+        raise ValueError("Unknown codec: %r" % codec) from e
+
+    return decompressfn(data)
+
+
 class CacheKeyError(KeyError):
     """
     Base class for cache errors
@@ -97,6 +130,14 @@ class BaseCache:
     def get(self, key):
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def get_stale(self, key):
+        """
+        Like get() but expired values are returned too. Expired keys are kept
+        (until overwritten, deleted or purged) so callers can revalidate them.
+        """
+        raise NotImplementedError()
+
     @abc.abstractmethod
     def set(self, key, value):
         raise NotImplementedError()
@@ -114,6 +155,9 @@ class NullCache(BaseCache):
     def get(self, key):
         raise CacheKeyMissError(key)
 
+    def get_stale(self, key):
+        raise CacheKeyMissError(key)
+
     def set(self, key, data):
         pass
 
@@ -131,11 +175,18 @@ class MemoryCache(BaseCache):
         now = _now()
 
         if now - ts > self.delta:
-            del(self._mem[key])
             raise CacheKeyExpiredError(key)
 
         return value
 
+    def get_stale(self, key):
+        try:
+            ts, value = self._mem[key]
+        except KeyError as e:
+            raise CacheKeyMissError(key) from e
+
+        return value
+
     def set(self, key, value):
         self._mem[key] = (_now(), value)
 
@@ -208,12 +259,24 @@ class DiskCache(BaseCache):
             raise CacheKeyMissError(key) from e
 
         if expired:
-            self.delete(key)
             raise CacheKeyExpiredError(key)
 
+        return self._read(key, p)
+
+    def get_stale(self, key):
+        p = pathlib.Path(self.encode_key(key))
+        if not p.exists():
+            raise CacheKeyMissError(key)
+
+        return self._read(key, p)
+
+    def _read(self, key, p):
         try:
             return self.decode_value(p.read_bytes())
 
+        except FileNotFoundError as e:
+            raise CacheKeyMissError(key) from e
+
         except EOFError as e:
             self.delete(key)
             raise CacheKeyError(key) from e
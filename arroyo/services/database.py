@@ -181,6 +181,33 @@ class Download(Base):
     )
 
 
+class Watermark(Base):
+    # Newest source seen in a provider feed, see
+    # scraper.Engine.process_incremental
+    __tablename__ = "watermark"
+    feed = sa.Column(sa.String, primary_key=True)
+    source_id = sa.Column(sa.String, nullable=False)
+    created = sa.Column(sa.Integer, nullable=True)
+
+
+class MirrorScore(Base):
+    # See scraper.MirrorSelector
+    __tablename__ = "mirror_score"
+    base = sa.Column(sa.String, primary_key=True)
+    latency = sa.Column(sa.Float, nullable=True)
+    errors = sa.Column(sa.Float, nullable=False, default=0.0)
+    updated = sa.Column(sa.Float, nullable=False, default=0.0)
+
+
+class Circuit(Base):
+    # See scraper.CircuitBreaker
+    __tablename__ = "circuit"
+    provider = sa.Column(sa.String, primary_key=True)
+    failures = sa.Column(sa.Integer, nullable=False, default=0)
+    opened = sa.Column(sa.Float, nullable=True)
+    probing = sa.Column(sa.Float, nullable=True)
+
+
 class Database:
     MAPPING = {
         schema.Episode: (Episode, ["series", "year", "season", "number"]),
@@ -255,6 +282,47 @@ class Database:
         except exc.NoResultFound:
             return None
 
+    def get_watermark(self, feed):
+        obj = self.sess.query(Watermark).get(feed)
+        if obj is None:
+            return None
+
+        return dict(source_id=obj.source_id, created=obj.created)
+
+    def set_watermark(self, feed, source_id, created=None):
+        m = Watermark(feed=feed, source_id=source_id, created=created)
+
+        self.sess.merge(m)
+        self.sess.commit()
+
+    def get_mirror_scores(self):
+        return {
+            obj.base: dict(latency=obj.latency, errors=obj.errors,
+                           updated=obj.updated)
+            for obj in self.sess.query(MirrorScore)
+        }
+
+    def set_mirror_score(self, base, latency, errors, updated):
+        m = MirrorScore(base=base, latency=latency, errors=errors,
+                        updated=updated)
+
+        self.sess.merge(m)
+        self.sess.commit()
+
+    def get_circuits(self):
+        return {
+            obj.provider: dict(failures=obj.failures, opened=obj.opened,
+                               probing=obj.probing)
+            for obj in self.sess.query(Circuit)
+        }
+
+    def set_circuit(self, provider, failures, opened, probing):
+        m = Circuit(provider=provider, failures=failures, opened=opened,
+                    probing=probing)
+
+        self.sess.merge(m)
+        self.sess.commit()
+
     # def update_entity(self, entity, state=_UNDEF):
     #     # py3.9: https://www.python.org/dev/peps/pep-0584/
     #     data = self._qdict_for_entity(entity)
@@ -18,14 +18,40 @@
 # USA.
 
 
+import pickle
+import signal
+import time
 import unittest
+from concurrent import futures
+from unittest import mock
 
 
-from arroyo.analyze import analyze
-from arroyo.schema import Movie
+import guessit
 
 
-from testlib import build_source
+from arroyo import analyze as analyzemod
+from arroyo.analyze import (
+    AnalysisTimeoutError,
+    analyze,
+    analyze_iter,
+    analyze_one,
+    dedup,
+    fast_parse,
+    parse,
+    set_distributors,
+    version_stamp,
+    KNOWN_DISTRIBUTORS,
+    LazyMetadata,
+    NormalizationError,
+    Tags,
+    ParseCache,
+    WorkerPool
+)
+from arroyo.schema import Episode, Movie
+from arroyo.services.cache import MemoryCache
+
+
+from testlib import build_source, sample_names
 
 
 class TestAnalyze(unittest.TestCase):
@@ -38,5 +64,363 @@ class TestAnalyze(unittest.TestCase):
         self.assertTrue(isinstance(asrc.entity, Movie))
 
 
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ParseCache(MemoryCache(delta=-1))
+
+    def test_hit_skips_guessit(self):
+        src = build_source('Series.Name.S01E02.Pilot.1080p.WEB.h264-GROUP')
+        asrc1 = analyze(src, mp=False, cache=self.cache)[0]
+
+        with mock.patch('guessit.guessit') as guessit_mock:
+            asrc2 = analyze(src, mp=False, cache=self.cache)[0]
+            self.assertFalse(guessit_mock.called)
+
+        self.assertTrue(isinstance(asrc2.entity, Episode))
+        self.assertEqual(asrc1.entity, asrc2.entity)
+        self.assertEqual(asrc1.metadata, asrc2.metadata)
+
+    def test_errors_are_cached(self):
+        src = build_source('Some.Movie.Part.1.2019.1080p')
+        self.assertEqual(analyze(src, mp=False, cache=self.cache), [])
+
+        with mock.patch('guessit.guessit') as guessit_mock:
+            self.assertEqual(analyze(src, mp=False, cache=self.cache), [])
+            self.assertFalse(guessit_mock.called)
+
+    def test_stamp_mismatch(self):
+        src = build_source('Series.Name.S01E02.Pilot.1080p.WEB.h264-GROUP')
+        analyze(src, mp=False, cache=self.cache)
+
+        self.cache.stamp = 'other-version'
+        with mock.patch('guessit.guessit', return_value={}) as guessit_mock:
+            analyze(src, mp=False, cache=self.cache)
+            self.assertTrue(guessit_mock.called)
+
+
+class TestDedup(unittest.TestCase):
+    def test_merge(self):
+        name = 'Series.Name.S01E02.720p.HDTV'
+        srcs = [
+            build_source(name, provider='a', seeds=10, leechers=None,
+                         created=200, hints={'type': 'episode'}),
+            build_source(name, provider='b', seeds=5, leechers=3,
+                         created=100, size=1024,
+                         hints={'type': 'movie', 'language': 'eng-us'}),
+            build_source('Other.Name.S01E02.720p.HDTV')
+        ]
+
+        res = dedup(*srcs)
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[0].provider, 'a')
+        self.assertEqual(res[0].seeds, 10)
+        self.assertEqual(res[0].leechers, 3)
+        self.assertEqual(res[0].created, 100)
+        self.assertEqual(res[0].size, 1024)
+        self.assertEqual(res[0].hints,
+                         {'type': 'episode', 'language': 'eng-us'})
+
+        # Original sources are left untouched
+        self.assertEqual(srcs[0].hints, {'type': 'episode'})
+        self.assertEqual(srcs[0].leechers, None)
+
+    def test_shared_parse(self):
+        name = 'Series.Name.S01E02.720p.HDTV'
+        srcs = [
+            build_source(name),
+            build_source(name, uri='magnet:?xt=urn:btih:' + 'a' * 40),
+            build_source(name, hints={'type': 'episode'})
+        ]
+
+        with mock.patch('arroyo.analyze._safe_parse',
+                        wraps=analyzemod._safe_parse) as m:
+            res = analyze(*srcs, mp=False)
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual([x.id for x in res], [x.id for x in srcs])
+        self.assertTrue(all([x.entity == res[0].entity for x in res]))
+
+
+class TestTimeout(unittest.TestCase):
+    def tearDown(self):
+        analyzemod._quarantine.clear()
+
+    def slow_parse(self, name, type_hint=None, **kwargs):
+        time.sleep(5)
+
+    def test_quarantine(self):
+        cache = ParseCache(MemoryCache(delta=-1))
+        name = 'Some.Slow.Name.S01E02.720p.HDTV'
+        srcs = [build_source(name), build_source('Series.Name.S01E02.HDTV')]
+
+        with mock.patch('arroyo.analyze.parse',
+                        side_effect=self.slow_parse) as m:
+            t0 = time.monotonic()
+            res = analyze(srcs[0], mp=False, cache=cache, timeout=0.1)
+            self.assertLess(time.monotonic() - t0, 1)
+            self.assertEqual(res, [])
+            self.assertEqual(m.call_count, 1)
+
+            # Skipped from quarantine and from cache on later runs
+            analyze(srcs[0], mp=False, cache=cache, timeout=0.1)
+            analyzemod._quarantine.clear()
+            analyze(srcs[0], mp=False, cache=cache, timeout=0.1)
+            self.assertEqual(m.call_count, 1)
+
+        self.assertTrue(isinstance(cache.get(name), AnalysisTimeoutError))
+        res = analyze(*srcs, mp=False, cache=cache, timeout=0.1)
+        self.assertEqual([x.name for x in res], [srcs[1].name])
+
+    def test_timeout_in_workers(self):
+        name = 'Some.Slow.Name.S01E02.720p.HDTV'
+        with WorkerPool(processes=1) as pool:
+            with mock.patch('arroyo.analyze.parse',
+                            side_effect=self.slow_parse):
+                res = analyze(build_source(name), mp=True, pool=pool,
+                              timeout=0.1)
+
+        self.assertEqual(res, [])
+        self.assertIn((name, None), analyzemod._quarantine)
+
+    def test_timeout_off_main_thread(self):
+        name = 'Some.Slow.Name.S01E02.720p.HDTV'
+        pool = analyzemod._time_limit_pool
+        # Restarted with the patched parse()
+        pool.close()
+        self.addCleanup(pool.close)
+
+        with futures.ThreadPoolExecutor(1) as executor:
+            with mock.patch('arroyo.analyze.parse',
+                            side_effect=self.slow_parse):
+                t0 = time.monotonic()
+                res = executor.submit(analyze, build_source(name), mp=False,
+                                      timeout=0.1).result()
+                self.assertLess(time.monotonic() - t0, 4)
+                self.assertEqual(res, [])
+                pid = pool._pool._pool[0].pid
+
+                analyzemod._quarantine.clear()
+                t0 = time.monotonic()
+                fut = executor.submit(analyze_one, build_source(name),
+                                      timeout=0.1)
+                with self.assertRaises(AnalysisTimeoutError):
+                    fut.result()
+                self.assertLess(time.monotonic() - t0, 4)
+
+        # The same worker is kept for all of them
+        self.assertEqual(pool._pool._pool[0].pid, pid)
+
+    def test_outer_timer(self):
+        fired = []
+        prev = signal.signal(signal.SIGALRM, lambda *args: fired.append(1))
+        self.addCleanup(signal.signal, signal.SIGALRM, prev)
+        self.addCleanup(signal.setitimer, signal.ITIMER_REAL, 0)
+
+        signal.setitimer(signal.ITIMER_REAL, 0.5)
+        analyze(build_source('Series.Name.S01E02.720p.HDTV'), mp=False,
+                timeout=5)
+
+        # Still armed, with the outer handler
+        self.assertGreater(signal.getitimer(signal.ITIMER_REAL)[0], 0)
+        time.sleep(1)
+        self.assertEqual(fired, [1])
+
+
+class TestWorkerPool(unittest.TestCase):
+    def test_reuse(self):
+        srcs = [build_source('Series.Name.S01E0%d.720p.HDTV' % x)
+                for x in range(1, 5)]
+
+        with WorkerPool(processes=2) as pool:
+            res1 = analyze(*srcs, mp=True, pool=pool)
+            pid1 = pool._pool._pool[0].pid
+            res2 = analyze(*srcs, mp=True, pool=pool)
+            pid2 = pool._pool._pool[0].pid
+
+        self.assertFalse(pool.started)
+        self.assertEqual(pid1, pid2)
+        self.assertEqual([x.entity.number for x in res1], [1, 2, 3, 4])
+        self.assertEqual([x.entity for x in res1], [x.entity for x in res2])
+
+    def test_analyze_iter(self):
+        srcs = [build_source('Series.Name.S01E0%d.720p.HDTV' % x)
+                for x in range(1, 5)]
+
+        with WorkerPool(processes=2) as pool:
+            g = analyze_iter(*srcs, mp=True, pool=pool)
+            self.assertFalse(isinstance(g, list))
+            res = list(g)
+
+        self.assertEqual(
+            sorted([x.entity.number for x in res]),
+            sorted([x.entity.number for x in analyze_iter(*srcs, mp=False)]))
+
+    def test_chunksize(self):
+        pool = WorkerPool(processes=2)
+        self.assertEqual(pool.chunksize(1), 1)
+        self.assertEqual(pool.chunksize(80), 10)
+        self.assertEqual(pool.chunksize(81), 11)
+
+
+class TestDistributors(unittest.TestCase):
+    def tearDown(self):
+        set_distributors(KNOWN_DISTRIBUTORS)
+
+    def test_strip_all(self):
+        entity, metadata, other = parse(
+            'Series.Name.S01E02.720p.HDTV.x264-GROUP[eztv].mkv[EZTV][ettv]')
+        self.assertEqual(entity.series, 'Series Name')
+        self.assertEqual(metadata[Tags.RELEASE_GROUP], 'GROUP')
+        self.assertEqual(sorted(metadata[Tags.RELEASE_DISTRIBUTORS]),
+                         ['ettv', 'eztv'])
+
+    def test_configurable(self):
+        stamp = version_stamp()
+        set_distributors('foo, bar.baz')
+        self.assertNotEqual(stamp, version_stamp())
+
+        entity, metadata, other = parse(
+            'Series.Name.S01E02.720p.HDTV.x264-GROUP[bar.baz][eztv]')
+        self.assertEqual(metadata[Tags.RELEASE_DISTRIBUTORS], ['bar.baz'])
+        self.assertNotEqual(metadata[Tags.RELEASE_GROUP], 'GROUP')
+
+        set_distributors([])
+        entity, metadata, other = parse('Series.Name.S01E02.HDTV[eztv]')
+        self.assertFalse(Tags.RELEASE_DISTRIBUTORS in metadata)
+
+
+class TestLazyMetadata(unittest.TestCase):
+    def test_same_as_eager(self):
+        name = 'Series.Name.S01E02.Pilot.PROPER.1080p.WEB.h264-GROUP[eztv]'
+        eager = parse(name)
+        lazy = parse(name, lazy=True)
+
+        self.assertTrue(isinstance(lazy[1], LazyMetadata))
+        self.assertEqual(eager, lazy)
+        self.assertEqual(list(eager[1].items()), list(lazy[1].items()))
+        self.assertIs(lazy[1][Tags.RELEASE_PROPER], True)
+        self.assertEqual(pickle.loads(pickle.dumps(lazy[1])), eager[1])
+
+        with self.assertRaises(KeyError):
+            lazy[1][Tags.AUDIO_CODEC]
+        with self.assertRaises(KeyError):
+            lazy[1]['foo']
+
+    def test_analyze(self):
+        srcs = [build_source('Series.Name.S01E02.720p.HDTV.x264-GROUP')]
+
+        res = analyze(*srcs, mp=False, lazy=True)
+        self.assertTrue(isinstance(res[0].metadata, LazyMetadata))
+        self.assertEqual(res[0].metadata[Tags.VIDEO_SCREEN_SIZE], '720p')
+
+        res = analyze(*srcs, mp=False)
+        self.assertEqual(type(res[0].metadata), dict)
+
+
+class TestFastParse(unittest.TestCase):
+    def test_fallback(self):
+        self.assertEqual(fast_parse('Series.S01E02.720p.HDTV.x264-GROUP'), {
+            'title': 'Series', 'season': 1, 'episode': 2,
+            'screen_size': '720p', 'source': 'HDTV', 'video_codec': 'H.264',
+            'release_group': 'GROUP', 'type': 'episode'})
+
+        # Unknown tokens, type mismatch, country or language codes and
+        # groups named like a known token are left to guessit
+        self.assertIsNone(fast_parse('Series.S01E02.720p.UNKNOWN-GROUP'))
+        self.assertIsNone(fast_parse('Series.S01E02.720p-GROUP', 'movie'))
+        self.assertIsNone(fast_parse('Series.US.S01E02.720p-GROUP'))
+        self.assertIsNone(fast_parse('Series.Eng.S01E02.720p-GROUP'))
+        self.assertIsNone(fast_parse('Series.S01E02.720p-WEB'))
+
+    def test_streaming_service(self):
+        name = 'Series.S01E02.The.Title.1080p.AMZN.WEB-DL.DDP5.1.H.264-GROUP'
+        self.assertEqual(fast_parse(name), {
+            'title': 'Series', 'season': 1, 'episode': 2,
+            'episode_title': 'The Title', 'screen_size': '1080p',
+            'streaming_service': 'Amazon Prime', 'source': 'Web',
+            'audio_codec': 'Dolby Digital Plus', 'audio_channels': '5.1',
+            'video_codec': 'H.264', 'release_group': 'GROUP',
+            'type': 'episode'})
+
+    def assertSameAsGuessit(self, names):
+        # Compares fast path results with guessit's, returns how many names
+        # took the fast path
+        class _GuessitCalled(Exception):
+            pass
+
+        def _parse(name, fast):
+            try:
+                entity, metadata, other = parse(name, fast=fast)
+            except NormalizationError as e:
+                return repr(e)
+
+            return (entity, metadata, dict(other))
+
+        matched = 0
+        for name in names:
+            # Only names handled by the fast path are interesting
+            with mock.patch('guessit.guessit', side_effect=_GuessitCalled):
+                try:
+                    res = _parse(name, fast=True)
+                except _GuessitCalled:
+                    continue
+
+            matched += 1
+            self.assertEqual(res, _parse(name, fast=False), msg=name)
+
+        return matched
+
+    def test_samples_against_guessit(self):
+        extra = [
+            'Series.Name.Eng.S01E02.720p.WEB.x264-GRP',
+            'Series.Name.Fre.S01E02.720p.WEB.x264-GRP',
+            'Movie.Name.Ita.2019.1080p.BluRay.x264-GRP',
+            'Series.Name.S01E02.720p-WEB',
+            'Series.Name.S01E02.720p.WEB-HDTV',
+            'Series.Name.ER.S01E02.720p.HDTV.x264-GRP',
+            'Series.Name.2019.S01E02.720p.HDTV.x264-GRP',
+            'Series.Name.S01E02.The.Long.Night.1080p.AMZN.WEB-DL.DDP5.1.'
+            'H.264-GRP',
+            'Series.Name.S01.1080p.NF.WEBRip.DD5.1.x264-GRP.mkv',
+            'Movie.Name.2019.BRRip.XviD.MP3-GRP',
+        ]
+
+        self.assertTrue(self.assertSameAsGuessit(sample_names() + extra) > 0)
+
+    def test_generated_against_guessit(self):
+        # Samples don't have most of guessit's words in a title: try all of
+        # them, as they are and inside longer words, where titles and
+        # episode titles go
+        templates = [
+            'Series.%s.S01E02.720p.HDTV.x264-GRP',
+            'The.%s.Name.S01E02.720p.HDTV.x264-GRP',
+            'Series.Name.S01E02.%s.720p.WEB.x264-GRP',
+            'Series.Name.S01E02.The.%s.Night.1080p.AMZN.WEB-DL.DDP5.1.'
+            'H.264-GRP',
+            'Movie.%s.2019.1080p.BluRay.x264-GRP',
+        ]
+
+        # guessit builds its rules on first use
+        guessit.guessit('Warm.Up.S01E01.720p.WEB.x264-GROUP')
+        names = [template % word
+                 for word in ['Finale', 'Fix', 'Fixed', 'Festival',
+                              'Readnfo', 'Web', 'Long', 'Bridge', 'ReMpeg']
+                 for template in templates]
+
+        # Each word only once, rotating templates to keep it fast enough
+        vocabulary = set()
+        for pattern in guessit.api.default_api.rebulk.effective_patterns():
+            for x in getattr(pattern, 'patterns', []):
+                if isinstance(x, str) and x.isalpha():
+                    vocabulary.add(x.title())
+
+        for (n, x) in enumerate(sorted(vocabulary)):
+            words = [x, x + 'e', x + 's', x + 'ed', 'Re' + x]
+            names.extend(templates[(n + i) % len(templates)] % word
+                         for (i, word) in enumerate(words))
+
+        self.assertTrue(self.assertSameAsGuessit(names) > 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2015 Luis López <luis@cuarentaydos.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301,
+# USA.
+
+
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+from concurrent import futures
+from unittest import mock
+
+
+from arroyo import analyze, query
+from arroyo.application import App
+
+
+from testlib import build_source
+
+
+class TestAsyncQuery(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        env = mock.patch.dict(os.environ, {'XDG_CACHE_HOME': tmpdir.name})
+        env.start()
+        self.addCleanup(env.stop)
+
+        settings_path = tmpdir.name + '/settings.ini'
+        open(settings_path, 'w').close()
+
+        self.app = App(settings_path=settings_path,
+                       database_path=tmpdir.name + '/arroyo.db')
+        self.app.analysis_cache = None
+        self.app.analysis_pool = analyze.WorkerPool(processes=1)
+        self.addCleanup(self.app.close)
+
+    def test_concurrent_queries_share_pool(self):
+        async def _aprocess(*ctxs):
+            return [build_source('Series.Name.S01E0%d.720p.HDTV' % x)
+                    for x in range(1, 4)]
+
+        pool = multiprocessing.Pool
+
+        def _pool(*args, **kwargs):
+            # Slow start, so queries race to start the pool
+            time.sleep(0.1)
+            return pool(*args, **kwargs)
+
+        async def _main(executor):
+            q = query.Query.fromstring('Series Name')
+            return await asyncio.gather(*[
+                self.app.aquery(q, executor=executor)
+                for x in range(4)])
+
+        # No network, every query gets the same sources
+        self.app._scrape_contexts = lambda *args: []
+        self.app.scraper.aprocess = _aprocess
+        with mock.patch.object(analyze.multiprocessing, 'Pool',
+                               side_effect=_pool) as pool_cls, \
+                futures.ThreadPoolExecutor(4) as executor:
+            results = asyncio.run(_main(executor))
+
+        self.assertEqual(pool_cls.call_count, 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(x == results[0] for x in results))
+
+
+if __name__ == '__main__':
+    unittest.main()
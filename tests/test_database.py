@@ -129,6 +129,23 @@ class DatabaseAPITest(unittest.TestCase):
         self.db.set_entity_state(e, 'skipped')
         self.assertEqual(self.db.get_entity_state(e), 'skipped')
 
+    def test_get_set_watermark(self):
+        self.assertEqual(self.db.get_watermark('foo'), None)
+
+        self.db.set_watermark('foo', 'urn:btih:x', 100)
+        self.db.set_watermark('foo', 'urn:btih:y', 200)
+        self.assertEqual(self.db.get_watermark('foo'),
+                         {'source_id': 'urn:btih:y', 'created': 200})
+
+    def test_get_set_circuit(self):
+        self.assertEqual(self.db.get_circuits(), {})
+
+        self.db.set_circuit('foo', 3, 100.0, None)
+        self.db.set_circuit('foo', 4, 200.0, 250.0)
+        self.assertEqual(self.db.get_circuits(),
+                         {'foo': {'failures': 4, 'opened': 200.0,
+                                  'probing': 250.0}})
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -3,10 +3,12 @@ import unittest
 
 import time
 
+from arroyo.analyze import analyze_one
 from arroyo.services import Services
 from arroyo.plugins.filters.generic import (
     SourceAttributeFilter,
     EpisodeAttributeFilter,
+    MetadataAttributeFilter,
     MovieAttributeFilter
 )
 from arroyo.plugins.sorters.basic import (
@@ -15,6 +17,7 @@ from arroyo.plugins.sorters.basic import (
 
 from testlib import (
     build_item,
+    build_source,
 )
 
 
@@ -118,6 +121,28 @@ class TestEntityAttributeFilter(unittest.TestCase):
         self.assertFalse(f.filter('movie-year', '1998', m2))
 
 
+class TestLazyMetadata(unittest.TestCase):
+    def build_item(self, name):
+        return analyze_one(build_source(name), lazy=True)
+
+    def test_metadata_filter(self):
+        f = MetadataAttributeFilter(Services())
+        i = self.build_item('Series.S01E02.720p.WEB.x264-GROUP')
+
+        self.assertTrue(f.filter('quality', '720p', i))
+        self.assertTrue(f.filter('codec', 'h264', i))
+        self.assertFalse(f.filter('source', 'hdtv', i))
+
+    def test_sorter(self):
+        s = BasicSorter(Services())
+
+        i1 = self.build_item('series x s01e01.mp4')
+        i2 = self.build_item('series x s01e01.proper.mp4')
+
+        r = s.sort([i1, i2])
+        self.assertTrue(r[0] == i2)
+
+
 class TestSorter(unittest.TestCase):
     def test_proper(self):
         s = BasicSorter(Services())
@@ -18,13 +18,20 @@
 # USA.
 
 
+import types
 import unittest
 
 
+from arroyo.plugins.filters.generic import SourceAttributeFilter
 from arroyo.query import (
+    Engine,
     Query,
     InvalidQueryParameters
 )
+from arroyo.services import Services
+
+
+from testlib import build_item
 
 
 TESTS = [
@@ -64,5 +71,31 @@ class QueryTest(unittest.TestCase):
                     msg=s)
 
 
+class EngineTest(unittest.TestCase):
+    def test_apply_stream(self):
+        srvs = Services()
+        engine = Engine(srvs)
+        ctx = [(SourceAttributeFilter(srvs), 'size-min', 100)]
+        items = [build_item('Series A S01E0%d' % x, size=x * 50)
+                 for x in range(1, 5)]
+
+        consumed = []
+
+        def _stream():
+            for item in items:
+                consumed.append(item)
+                yield item
+
+        res = engine.apply(ctx, _stream())
+        self.assertTrue(isinstance(res, types.GeneratorType))
+
+        # First match is available before consuming the whole stream
+        self.assertEqual(next(res), items[1])
+        self.assertEqual(len(consumed), 2)
+        self.assertEqual(list(res), items[2:])
+
+        self.assertEqual(engine.apply(ctx, items), items[1:])
+
+
 if __name__ == '__main__':
     unittest.main()
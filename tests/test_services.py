@@ -18,10 +18,11 @@
 # USA.
 
 
+import time
 import unittest
 
 
-from arroyo.services import ClassLoader
+from arroyo.services import ClassLoader, cache
 
 
 class Foo:
@@ -51,5 +52,43 @@ class TestClassLoader(unittest.TestCase):
         self.assertTrue(foo.kwargs == dict(a=3))
 
 
+class TestCache(unittest.TestCase):
+    def _test_get_stale(self, c):
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get_stale('foo')
+
+        c.set('foo', {'body': 'bar'})
+        time.sleep(0.01)
+        with self.assertRaises(cache.CacheKeyExpiredError):
+            c.get('foo')
+
+        # Expired entries are kept for revalidation
+        self.assertEqual(c.get_stale('foo'), {'body': 'bar'})
+
+        c.purge()
+        with self.assertRaises(cache.CacheKeyMissError):
+            c.get_stale('foo')
+
+    def test_compress(self):
+        data = b'<html>' + b'<tr><td>foo</td></tr>' * 100 + b'</html>'
+        blob = cache.compress(data)
+
+        self.assertTrue(blob.startswith(b'\0zlib\0'))
+        self.assertLess(len(blob), len(data) / 5)
+        self.assertEqual(cache.decompress(blob), data)
+
+        # Uncompressed data has no header
+        self.assertEqual(cache.decompress(data), data)
+
+        with self.assertRaises(ValueError):
+            cache.decompress(b'\0foo\0' + data)
+
+    def test_memory_get_stale(self):
+        self._test_get_stale(cache.MemoryCache(delta=0))
+
+    def test_disk_get_stale(self):
+        self._test_get_stale(cache.DiskCache(delta=0))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -19,12 +19,16 @@
 
 
 import hashlib
+import pathlib
 from urllib import parse
 
 from arroyo.analyze import analyze_one
 from arroyo.schema import Source
 
 
+SAMPLES_PATH = pathlib.Path(__file__).parent / 'samples'
+
+
 def build_source(name, **kwargs):
     sha1 = hashlib.sha1()
     sha1.update(name.encode('utf-8'))
@@ -43,3 +47,28 @@ def build_item(name, **kwargs):
     src = build_source(name, **kwargs)
     item = analyze_one(src)
     return item
+
+
+def read_sample(filename):
+    return (SAMPLES_PATH / filename).read_text(encoding='utf-8')
+
+
+def sample_names():
+    """
+    Source names from all recorded samples, without duplicates.
+    """
+    from arroyo import defaults
+    from arroyo.plugins.commands.dev import sample_names
+    from arroyo.scraper import Engine
+    from arroyo.services import Services
+    from arroyo.services.loader import ClassLoader
+
+    srvs = Services(loader=ClassLoader(defaults.PLUGINS))
+    for (k, v) in defaults.SETTINGS.items():
+        srvs.settings.set(k, v)
+
+    engine = Engine(srvs)
+    try:
+        return sample_names(engine, SAMPLES_PATH)
+    finally:
+        engine.close()